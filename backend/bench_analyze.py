@@ -0,0 +1,89 @@
+"""Kiểm tra kết quả và so sánh tốc độ /api/analyze giữa chế độ "pandas" và "mongo" (aggregation pipeline).
+
+Cần một mongod local (MONGO_URL). Dữ liệu giả lập được ghi vào database riêng (mặc định
+hpe_reports_bench) và bị xoá khi chạy xong.
+
+Chạy: python bench_analyze.py [số_site] [số_device_mỗi_site] [số_giờ]
+"""
+import os
+import sys
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("MONGO_DB_NAME", "hpe_reports_bench")
+
+from database_mongo import client, database, reports_collection, init_mongo_indexes
+from engine import AnalyzerEngine
+
+
+def make_records(n_sites, n_devices, hours, seed=0):
+    """Snapshot mỗi 5 phút cho từng site, có một phần snapshot bị trùng phút như dữ liệu thật."""
+    rnd = random.Random(seed)
+    now = datetime.now().replace(second=0, microsecond=0)
+    records = []
+    for s in range(n_sites):
+        site = f"SITE_{s:02d}"
+        for step in range(hours * 12):
+            dt_obj = now - timedelta(minutes=5 * step)
+            copies = 2 if rnd.random() < 0.05 else 1  # file bị upload 2 lần
+            for _ in range(copies):
+                for d in range(n_devices):
+                    records.append({
+                        "dt_obj": dt_obj,
+                        "site": site,
+                        "device": f"AP-{s:02d}-{d:03d}",
+                        "clients": rnd.randint(0, 60),
+                        "health": rnd.choice(["100", "95", "80", "60"]),
+                        "state": rnd.choice(["Up"] * 8 + ["Down", "up"]),
+                        "model": "AP-515",
+                        "ip": "",
+                    })
+    return records
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - start
+
+
+async def main(n_sites, n_devices, hours):
+    engine = AnalyzerEngine()
+    await client.drop_database(database.name)
+    await init_mongo_indexes()
+
+    # Ghi như lúc ingest: snapshot trùng được gộp theo khoá (site, device, dt_obj)
+    records = make_records(n_sites, n_devices, hours)
+    stored = 0
+    for i in range(0, len(records), 20000):
+        stored += await engine._insert_records(records[i:i + 20000])
+    print(f"Seeded {stored} of {len(records)} records ({n_sites} sites x {n_devices} devices, {hours}h)")
+
+    cases = [
+        (None, "All Devices", None),
+        (None, "All Devices", hours // 2),
+        (["SITE_00"], "All Devices", None),
+        (["SITE_00", "SITE_01"], "AP-01-001", None),
+    ]
+    try:
+        for sites, device, window in cases:
+            for metric in ["clients", "health", "state"]:
+                old, t_old = await timed(engine.analyze_metric(sites, device, metric, window, mode="pandas"))
+                new, t_new = await timed(engine.analyze_metric(sites, device, metric, window, mode="mongo"))
+                query = engine._site_time_query(sites, window, "dt_obj")
+                if device != "All Devices": query["device"] = device
+                # Chế độ pandas chỉ đọc tối đa 100k bản ghi nên không so sánh được khi vượt quá
+                capped = await reports_collection.count_documents(query) > 100000
+                status = "CAPPED" if capped else ("OK" if old == new else "MISMATCH")
+                print(f"{status:8} {metric:7} sites={sites or 'all'} device={device} hours={window} "
+                      f"| pandas {t_old:6.3f}s ({len(old)} pts) | mongo {t_new:6.3f}s")
+                assert capped or old == new, (old[:5], new[:5])
+    finally:
+        await client.drop_database(database.name)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    asyncio.run(main(*(args + [5, 40, 48][len(args):])))
@@ -0,0 +1,78 @@
+"""So sánh bộ nhớ và thời gian của metric_from_frame giữa DataFrame chuỗi object (cách cũ) và dtype gọn
+(categorical + int32, nhóm theo dt.floor) cho trường hợp xấu nhất 100k bản ghi của filter_data.
+
+Chạy: python bench_frames.py [số_bản_ghi]
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from engine import AnalyzerEngine, compact_frame
+
+
+def legacy_metric_from_frame(df, metric):
+    """Bản sao metric_from_frame trước đây (strip + strftime từng dòng, nhóm theo chuỗi)."""
+    if df.empty: return []
+    df['site'] = df['site'].astype(str).str.strip()
+    df['device'] = df['device'].astype(str).str.strip()
+    df['time_str'] = df['dt_obj'].dt.strftime("%Y-%m-%d %H:%M")
+
+    result_data = []
+    if metric == "clients":
+        df_dedup = df.groupby(['site', 'device', 'time_str'])['clients'].max().reset_index()
+        chart_data = df_dedup.groupby('time_str')['clients'].sum().sort_index()
+        result_data = [{"time": t, "clients": int(c)} for t, c in chart_data.items()]
+    elif metric in ["health", "state"]:
+        df_dedup = df.sort_values('dt_obj', kind='stable').drop_duplicates(['site', 'device', 'time_str'], keep='last')
+        dist = df_dedup[metric].value_counts()
+        result_data = [{"name": str(label), "value": int(val)} for label, val in dist.items()]
+    return result_data
+
+
+def make_records(n_rows, seed=0):
+    """Records giống kết quả find() của filter_data: 20 site x 250 device, snapshot 5 phút (không trùng khoá như trong DB)."""
+    rnd = random.Random(seed)
+    now = datetime.now().replace(second=0, microsecond=0)
+    records = []
+    step = 0
+    while len(records) < n_rows:
+        for s in range(20):
+            for d in range(250):
+                records.append({
+                    "dt_obj": now - timedelta(minutes=5 * step),
+                    "site": f"SITE_{s:02d}",
+                    "device": f"AP-{s:02d}-{d:03d}",
+                    "clients": rnd.randint(0, 60),
+                    "health": rnd.choice(["100", "95", "80", "60", "85%"]),
+                    "state": rnd.choice(["Up"] * 8 + ["Down", "up"]),
+                })
+        step += 1
+    return records[:n_rows]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main(n_rows):
+    records = make_records(n_rows)
+    old_df, t_build_old = timed(pd.DataFrame, records)
+    new_df, t_compact = timed(compact_frame, old_df)
+    mb = lambda df: df.memory_usage(deep=True).sum() / 1024 ** 2
+    print(f"{n_rows} rows | object DataFrame {mb(old_df):6.1f} MB | compact {mb(new_df):6.1f} MB "
+          f"| build {t_build_old:.3f}s + compact {t_compact:.3f}s")
+
+    for metric in ["clients", "health", "state"]:
+        old, t_old = timed(legacy_metric_from_frame, old_df.copy(), metric)
+        new, t_new = timed(AnalyzerEngine.metric_from_frame, new_df, metric)
+        assert old == new, f"{metric}: khác kết quả cách cũ"
+        print(f"{metric:7} | object {t_old:6.3f}s | compact {t_new:6.3f}s | x{t_old / t_new:4.1f} ({len(new)} pts)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
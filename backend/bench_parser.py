@@ -0,0 +1,92 @@
+"""So sánh tốc độ parse file giữa vòng lặp iterrows cũ và records_from_frame (theo cột).
+
+Chạy: python bench_parser.py
+"""
+import random
+import time
+from io import BytesIO
+from datetime import datetime
+
+import pandas as pd
+
+from engine import AnalyzerEngine, records_from_frame
+
+
+def legacy_records(df, dt_obj, site_name):
+    """Bản sao vòng lặp iterrows trước đây, giữ lại làm chuẩn so sánh."""
+    all_records = []
+    for _, row in df.iterrows():
+        dev = str(row.get("Device", row.get("Name", ""))).strip()
+        if not dev or dev.lower() in ["device", "nan", ""]: continue
+
+        try: client_count = int(float(row.get("Clients", 0)))
+        except: client_count = 0
+
+        all_records.append({
+            "dt_obj": dt_obj,
+            "site": site_name,
+            "device": str(dev),
+            "clients": client_count,
+            "health": str(row.get("Health", "")),
+            "state": str(row.get("State", "")),
+            "model": str(row.get("Model", "")),
+            "ip": str(row.get("Ip Address", "") or row.get("Ip", ""))
+        })
+    return all_records
+
+
+def make_csv(n_rows, seed=0):
+    """Sinh file CSV giả lập giống file export AP, có lẫn dòng rác và giá trị lỗi."""
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        r = rnd.random()
+        if r < 0.01:
+            dev = "Device"  # header lặp lại
+        elif r < 0.02:
+            dev = ""
+        else:
+            dev = f" AP-{i % 5000:04d} "
+        clients = rnd.choice([str(rnd.randint(0, 80)), f"{rnd.uniform(0, 80):.1f}", "", "n/a"])
+        rows.append({
+            "Device": dev,
+            "Clients": clients,
+            "Health": rnd.choice(["100", "85%", "", "Good"]),
+            "State": rnd.choice(["Up", "Down", "up", ""]),
+            "Model": rnd.choice(["AP-515", "AP-535", ""]),
+            "IP Address": rnd.choice([f"10.0.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}", ""]),
+        })
+    buf = BytesIO()
+    pd.DataFrame(rows).to_csv(buf, index=False)
+    return buf.getvalue()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench(n_rows):
+    content = make_csv(n_rows)
+    fname = "SITE_A - 01-02-2025 08h30.csv"
+    dt_obj, site = datetime(2025, 2, 1, 8, 30), "SITE_A"
+
+    df = pd.read_csv(BytesIO(content))
+    df.columns = [str(c).strip().title() for c in df.columns]
+
+    old, t_old = timed(legacy_records, df, dt_obj, site)
+    new, t_new = timed(records_from_frame, df, dt_obj, site)
+    assert old == new, "records_from_frame khác kết quả vòng lặp cũ"
+
+    engine = AnalyzerEngine()
+    full, t_full = timed(engine.process_file_data, BytesIO(content), fname)
+    assert full == new
+
+    print(f"{n_rows:>7} rows | iterrows {t_old:7.3f}s | columnar {t_new:7.3f}s "
+          f"| x{t_old / t_new:5.1f} | process_file_data {t_full:6.3f}s ({len(new)} records)")
+
+
+if __name__ == "__main__":
+    for n in (10_000, 100_000):
+        bench(n)
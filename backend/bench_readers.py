@@ -0,0 +1,75 @@
+"""Tốc độ đọc file export theo từng định dạng / engine: CSV, xlsx bằng openpyxl (cách cũ, đọc mọi cột),
+openpyxl chỉ đọc các cột cần dùng và calamine (nếu đã cài python-calamine).
+
+File giả lập có thêm các cột không dùng tới như file export thật. Kết quả records của mọi cách đọc phải giống nhau.
+
+Chạy: python bench_readers.py [số_dòng ...]
+"""
+import importlib.util
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+import engine
+from bench_parser import make_csv
+
+# Các cột có trong file export nhưng process_file_data không dùng
+EXTRA_COLUMNS = ["Serial", "Mac Address", "Group", "Firmware", "Uptime", "Radio 0 Channel", "Radio 1 Channel", "Labels"]
+
+
+def make_frame(n_rows):
+    df = pd.read_csv(BytesIO(make_csv(n_rows)), dtype=str, keep_default_na=False)
+    for i, name in enumerate(EXTRA_COLUMNS):
+        df[name] = [f"{name[:3].upper()}-{i}-{r:06d}" for r in range(n_rows)]
+    return df
+
+
+def legacy_frame(content, fname):
+    """Cách đọc trước đây: pandas mặc định, mọi cột."""
+    df = pd.read_csv(BytesIO(content)) if fname.endswith(".csv") else pd.read_excel(BytesIO(content))
+    df.columns = [str(c).strip().title() for c in df.columns]
+    return df
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench(n_rows):
+    df = make_frame(n_rows)
+    csv_buf, xlsx_buf = BytesIO(), BytesIO()
+    df.to_csv(csv_buf, index=False)
+    df.to_excel(xlsx_buf, index=False)
+    files = {"csv": csv_buf.getvalue(), "xlsx": xlsx_buf.getvalue()}
+    dt_obj, site = datetime(2025, 2, 1, 8, 30), "SITE_A"
+
+    cases = [
+        ("csv (all columns)", "csv", lambda c: legacy_frame(c, "a.csv")),
+        ("csv", "csv", lambda c: engine.read_report_frame(BytesIO(c), "a.csv")),
+        ("xlsx openpyxl (all columns)", "xlsx", lambda c: legacy_frame(c, "a.xlsx")),
+        ("xlsx openpyxl", "xlsx", lambda c: engine._read_excel(BytesIO(c), "openpyxl")),
+    ]
+    if importlib.util.find_spec("python_calamine"):
+        cases.append(("xlsx calamine", "xlsx", lambda c: engine._read_excel(BytesIO(c), "calamine")))
+
+    expected = None
+    print(f"{n_rows} rows | csv {len(files['csv']) / 1024 ** 2:.1f} MB | xlsx {len(files['xlsx']) / 1024 ** 2:.1f} MB "
+          f"| XLSX_ENGINE={engine.XLSX_ENGINE}")
+    for name, fmt, read in cases:
+        frame, elapsed = timed(read, files[fmt])
+        frame.columns = [str(c).strip().title() for c in frame.columns]
+        records = engine.records_from_frame(frame, dt_obj, site)
+        expected = expected if expected is not None else records
+        assert records == expected, f"{name}: records khác cách đọc CSV cũ"
+        print(f"  {name:28} {elapsed:7.3f}s | {n_rows / elapsed:>10,.0f} rows/s | "
+              f"{len(files[fmt]) / 1024 ** 2 / elapsed:6.1f} MB/s")
+
+
+if __name__ == "__main__":
+    for n in [int(a) for a in sys.argv[1:]] or [10_000, 50_000]:
+        bench(n)
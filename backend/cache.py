@@ -0,0 +1,100 @@
+import asyncio
+import functools
+import os
+import time
+from collections import OrderedDict
+
+# Thời gian sống của một entry. Dữ liệu chỉ đổi khi sync xong và lúc đó cache bị xoá,
+# TTL chỉ để giới hạn độ trễ khi dữ liệu bị ghi từ process khác.
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 300))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+
+
+class TTLCache:
+    """Cache kết quả của các hàm async trong process: hết hạn theo TTL, bỏ entry cũ nhất khi đầy (LRU).
+
+    Mỗi key chỉ load một lần dù nhiều request cùng hỏi (các request sau chờ kết quả của request đầu).
+    Giá trị trả về được dùng chung, nơi gọi không được sửa trực tiếp.
+    """
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (hết hạn lúc, giá trị)
+        self._locks = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, key):
+        entry = self._data.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._data.move_to_end(key)
+            return entry
+        return None
+
+    async def get_or_load(self, key, loader):
+        entry = self._fresh(key)
+        if entry:
+            self.hits += 1
+            return entry[1]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._fresh(key)
+            if entry:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            generation = self._generation
+            value = await loader()
+            # Bị invalidate trong lúc đang load -> kết quả có thể đã cũ, không lưu
+            if generation == self._generation:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_entries:
+                    old_key, _ = self._data.popitem(last=False)
+                    self._locks.pop(old_key, None)
+            return value
+
+    def invalidate(self):
+        self._data.clear()
+        self._locks.clear()
+        self._generation += 1
+
+    def discard(self, key):
+        """Xoá một key; các lần load đang chạy dở cũng không được lưu (có thể đã đọc dữ liệu cũ)."""
+        self._data.pop(key, None)
+        self._generation += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "ttl_seconds": self.ttl,
+            "max_entries": self.max_entries,
+        }
+
+
+def _freeze(value):
+    """Chuyển tham số thành key hashable; list site được sort để cùng tập site cho cùng key."""
+    if isinstance(value, (list, set)):
+        return tuple(sorted(_freeze(v) for v in value))
+    if isinstance(value, tuple):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def cached(method):
+    """Cache kết quả một method async của AnalyzerEngine trong self.cache, key theo tên method và tham số."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        key = (method.__name__, _freeze(args), _freeze(kwargs))
+        return await self.cache.get_or_load(key, lambda: method(self, *args, **kwargs))
+    return wrapper
@@ -1,4 +1,6 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
 from dotenv import load_dotenv
 
@@ -8,20 +10,108 @@ load_dotenv()
 MONGO_DETAILS = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 
 client = AsyncIOMotorClient(MONGO_DETAILS)
-database = client.hpe_reports
+database = client[os.getenv("MONGO_DB_NAME", "hpe_reports")]
 
 # Collections
 reports_collection = database.get_collection("records")
 files_collection = database.get_collection("processed_files")
 users_collection = database.get_collection("users")
 settings_collection = database.get_collection("settings")
+# Tổng hợp clients theo (site, phút), cập nhật lúc ingest để vẽ biểu đồ không cần đọc records
+client_rollups_collection = database.get_collection("client_rollups")
+# Trạng thái mới nhất của từng (site, device), dùng cho thống kê tổng quan
+device_latest_collection = database.get_collection("device_latest")
+# Records đã rút gọn theo 15 phút / 1 giờ cho các khoảng thời gian dài (xem retention.py)
+records_15m_collection = database.get_collection("records_15m")
+records_1h_collection = database.get_collection("records_1h")
+# client_rollups rút gọn theo 15 phút / 1 giờ, cùng các tầng với records
+client_rollups_15m_collection = database.get_collection("client_rollups_15m")
+client_rollups_1h_collection = database.get_collection("client_rollups_1h")
+# Lease + tiến độ chung và danh sách file của lượt sync R2 đang chạy (xem sync_coordinator.py)
+sync_runs_collection = database.get_collection("sync_runs")
+sync_tasks_collection = database.get_collection("sync_tasks")
+
+RECORD_KEY = [("site", 1), ("device", 1), ("dt_obj", 1)]
+
+async def dedupe_records(collection):
+    """Gộp các records trùng (site, device, dt_obj) có từ trước khi records có unique index.
+
+    Giữ bản ghi sau cùng với clients = MAX của nhóm (giống cách phân tích lọc trùng trước đây). Trả về số bản bị xoá.
+    """
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": {"site": "$site", "device": "$device", "dt_obj": "$dt_obj"},
+            "ids": {"$push": "$_id"},
+            "clients": {"$max": "$clients"},
+        }},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    ops, removed = [], 0
+    async for group in collection.aggregate(pipeline, allowDiskUse=True):
+        ops.append(UpdateOne({"_id": group["ids"][-1]}, {"$set": {"clients": group["clients"]}}))
+        ops.append(DeleteMany({"_id": {"$in": group["ids"][:-1]}}))
+        removed += len(group["ids"]) - 1
+        if len(ops) >= 1000:
+            await collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await collection.bulk_write(ops, ordered=False)
+    return removed
+
+async def ensure_unique_record_key(collection):
+    """Tạo unique index (site, device, dt_obj) cho records, gộp dữ liệu trùng có từ trước nếu chưa có index này."""
+    indexes = await collection.index_information()
+    if any(info["key"] == RECORD_KEY and info.get("unique") for info in indexes.values()):
+        return
+    for attempt in range(3):
+        removed = await dedupe_records(collection)
+        if removed:
+            print(f"MongoDB: merged {removed} duplicate records before adding unique key.")
+        # Index cùng khoá nhưng không unique (phiên bản cũ) phải xoá trước khi tạo bản unique
+        for name, info in indexes.items():
+            if info["key"] == RECORD_KEY:
+                try:
+                    await collection.drop_index(name)
+                except OperationFailure as e:
+                    # Worker khác vừa xoá index này
+                    if e.code != 27:
+                        raise
+        indexes = {}
+        try:
+            await collection.create_index(RECORD_KEY, unique=True)
+            return
+        except DuplicateKeyError:
+            # Worker khác ghi thêm bản trùng trong lúc đang gộp -> gộp lại rồi thử tiếp
+            if attempt == 2:
+                raise
 
 async def init_mongo_indexes():
     """Tạo indexes để tìm kiếm nhanh"""
-    # Index cho việc tìm kiếm biểu đồ
+    # Index cho records theo quy tắc Equality - Sort - Range (xem index_advisor.py để kiểm tra bằng explain)
+    # Không lọc site (All Sites) chỉ lọc khoảng thời gian; cũng dùng cho compaction / xoá dữ liệu quá hạn
     await reports_collection.create_index([("dt_obj", 1), ("site", 1), ("device", 1)])
+    # site + device bằng nhau, dt_obj theo khoảng; distinct("site") và distinct("device", {site}) quét index này.
+    # Unique: mỗi snapshot của một thiết bị chỉ có một bản ghi, ghi lại file cũ không làm records phình ra
+    await ensure_unique_record_key(reports_collection)
+    # site ($in) + khoảng dt_obj cho tất cả thiết bị; có đủ field của filter_data nên không cần đọc document
+    await reports_collection.create_index([("site", 1), ("dt_obj", 1), ("device", 1), ("clients", 1), ("health", 1), ("state", 1)])
+    # Index cho bảng tổng hợp clients
+    for collection in [client_rollups_collection, client_rollups_15m_collection, client_rollups_1h_collection]:
+        await collection.create_index([("site", 1), ("bucket", 1)], unique=True)
+        await collection.create_index("bucket")
+    await device_latest_collection.create_index([("site", 1), ("device", 1)], unique=True)
+    # $merge của compaction cần unique index trên (site, device, dt_obj)
+    for collection in [records_15m_collection, records_1h_collection]:
+        await collection.create_index([("site", 1), ("device", 1), ("dt_obj", 1)], unique=True)
+        await collection.create_index("dt_obj")
+        await collection.create_index([("site", 1), ("dt_obj", 1)])
+    # Worker nhận file theo thứ tự trong lượt sync
+    await sync_tasks_collection.create_index([("run_id", 1), ("status", 1), ("order", 1)])
     # Index cho việc tra cứu file đã xử lý
     await files_collection.create_index("filename", unique=True)
+    # Nhận ra file trùng nội dung được upload dưới tên khác
+    await files_collection.create_index("content_hash")
     # Index cho user
     await users_collection.create_index("username", unique=True)
     print("MongoDB Indexes created.")
@@ -1,41 +1,42 @@
 import asyncio
 import logging
-from main import app, fetch_r2_files, backend, sync_status
+import os
+from main import app, coordinator, sync_r2_files, update_sync_status
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("docker_entry")
 
+# Chu kỳ quét R2 (giây), tính chung cho mọi worker / replica
+AUTO_SYNC_INTERVAL = int(os.getenv("AUTO_SYNC_INTERVAL", 300))
+# Chu kỳ kiểm tra xem có lượt sync của worker khác đang chạy để tham gia không
+AUTO_SYNC_JOIN_INTERVAL = int(os.getenv("AUTO_SYNC_JOIN_INTERVAL", 15))
+
 async def auto_sync_loop():
     """
-    Vòng lặp vĩnh cửu: Quét R2 mỗi 5 phút một lần để đảm bảo độ trễ dữ liệu thấp.
+    Vòng lặp vĩnh cửu: Quét R2 mỗi AUTO_SYNC_INTERVAL giây (chỉ một worker quét nhờ lease trong MongoDB),
+    các worker còn lại tham gia tải / parse file của lượt sync đó.
     """
     logger.info("Background auto-sync loop started.")
     while True:
         try:
-            if not sync_status["is_syncing"]:
+            # Đang sync trong process này thì sync_r2_files trả về SYNC_NOT_PARTICIPATING
+            if await coordinator.due(AUTO_SYNC_INTERVAL):
                 logger.info("Auto-sync: Checking for new files on R2...")
-                files = await fetch_r2_files()
-                if files:
-                    sync_status["current_step"] = "Saving to Database..."
-                    new_count, skipped = await backend.load_multiple_from_memory(files)
-                    sync_status["last_message"] = f"Auto-sync: Added {new_count} records."
+                result = await sync_r2_files()
+                if isinstance(result, tuple):
+                    new_count, skipped = result
                     logger.info(f"Auto-sync: Added {new_count} records.")
-                else:
+                    # Worker khác có thể vẫn đang xử lý file của lượt sync: lấy tiến độ chung thay vì báo Idle
+                    update_sync_status(**await coordinator.status())
+                elif result is None:
                     logger.info("Auto-sync: No new data.")
-                
-                # Reset status after successful loop iteration
-                sync_status["is_syncing"] = False
-                sync_status["current_step"] = "Idle"
 
         except Exception as e:
             logger.error(f"Auto-sync Loop Error: {e}")
-            sync_status["is_syncing"] = False
-            sync_status["current_step"] = "Idle"
-            sync_status["last_message"] = f"Error: {str(e)}"
+            update_sync_status(is_syncing=False, current_step="Idle", last_message=f"Error: {str(e)}")
         
-        # Đợi 5 phút (300 giây) rồi mới quét tiếp
-        await asyncio.sleep(300)
+        await asyncio.sleep(AUTO_SYNC_JOIN_INTERVAL)
 
 @app.on_event("startup")
 async def trigger_startup_sync():
@@ -1,202 +1,930 @@
 import pandas as pd
+import numpy as np
 import os
-import re
-from datetime import datetime
+import hashlib
+import importlib.util
+from datetime import datetime, timedelta
 from io import BytesIO
 import asyncio
-from database_mongo import reports_collection, files_collection, init_mongo_indexes
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from cache import TTLCache, cached, _freeze
+from hot_cache import HotWindowCache
+from database_mongo import reports_collection, files_collection, client_rollups_collection, device_latest_collection, init_mongo_indexes
+from retention import RETENTION_ENABLED, ROLLUP_TOTAL, TIERS, find_window, mark_dirty, window_pipeline
+from filename_meta import FILENAME_DATE_FORMATS, parse_filename, snapshot_time
+
+# Các giá trị ở cột Device/Name bị coi là dòng rác (header lặp lại, ô trống)
+SKIP_DEVICE_VALUES = ["device", "nan", ""]
+
+# Các trạng thái hoạt động tốt
+UP_STATES = ["up", "online", "connected", "good", "active", "normal", "stable", "1", "true"]
+
+
+def _text_column(df, name, default=""):
+    """Cột dạng chuỗi giống hệt str(row.get(name, default)) nhưng chạy trên cả cột."""
+    if name not in df.columns:
+        return pd.Series(default, index=df.index, dtype=object)
+    # astype(object) để NaN được map thành "nan" như str() (dtype "str" của pandas giữ nguyên NaN)
+    return df[name].astype(object).map(str)
+
+
+def records_from_frame(df, dt_obj, site_name):
+    """Chuyển DataFrame của một file thành list dict cho MongoDB bằng thao tác theo cột.
+
+    Cho kết quả giống vòng lặp iterrows cũ: bỏ dòng có Device/Name rỗng, "nan" hoặc "device",
+    clients không đọc được thì về 0.
+    """
+    if df.empty:
+        return []
+
+    # Ưu tiên cột Device, không có thì dùng Name
+    dev = _text_column(df, "Device" if "Device" in df.columns else "Name").str.strip()
+    keep = ~dev.str.lower().isin(SKIP_DEVICE_VALUES)
+    if not keep.any():
+        return []
+    df = df[keep]
+    dev = dev[keep]
+
+    # int(float(x)) -> số bị lỗi/NaN/inf thành 0, phần thập phân bị cắt bỏ
+    if "Clients" in df.columns:
+        clients = pd.to_numeric(df["Clients"].astype(object), errors="coerce").to_numpy(dtype="float64", copy=True)
+        clients[~np.isfinite(clients)] = 0
+        clients = np.trunc(clients).astype("int64")
+    else:
+        clients = np.zeros(len(df), dtype="int64")
+
+    # Giữ nguyên hành vi `row.get("Ip Address", "") or row.get("Ip", "")`
+    ip = _text_column(df, "Ip")
+    if "Ip Address" in df.columns:
+        ip_address = df["Ip Address"].astype(object)
+        ip = ip_address.map(str).where(~ip_address.isin(["", 0]), ip)
+
+    # Chuẩn hoá khoảng trắng một lần lúc ingest (device đã strip ở trên), lúc phân tích không phải strip từng dòng
+    site_name = str(site_name).strip()
+    return [
+        {
+            "dt_obj": dt_obj,
+            "site": site_name,
+            "device": d,
+            "clients": c,
+            "health": h,
+            "state": st,
+            "model": m,
+            "ip": i,
+        }
+        for d, c, h, st, m, i in zip(
+            dev.tolist(),
+            clients.tolist(),
+            _text_column(df, "Health").tolist(),
+            _text_column(df, "State").tolist(),
+            _text_column(df, "Model").tolist(),
+            ip.tolist(),
+        )
+    ]
+
+
+def _stripped_category(series):
+    """Cột categorical đã strip khoảng trắng; chỉ strip trên danh sách giá trị khác nhau (dữ liệu cũ chưa chuẩn hoá)."""
+    series = series.astype("category")
+    cats = series.cat.categories
+    stripped = cats.map(lambda v: v.strip() if isinstance(v, str) else v)
+    if stripped.equals(cats):
+        return series
+    # Hai giá trị chỉ khác nhau ở khoảng trắng gộp thành một category
+    new_cats = pd.Index(stripped.unique())
+    codes = series.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, new_cats.get_indexer(stripped)[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(new_codes, new_cats), index=series.index, name=series.name)
+
+
+def compact_frame(df):
+    """DataFrame records với dtype gọn: site/device/health/state categorical, clients int32, dt_obj datetime64.
+
+    health giữ dạng nhãn (categorical) vì biểu đồ health hiển thị đúng giá trị gốc ("85%", "Good"...).
+    """
+    if df.empty:
+        return df
+    return df.assign(
+        dt_obj=pd.to_datetime(df["dt_obj"]),
+        site=_stripped_category(df["site"]),
+        device=_stripped_category(df["device"]),
+        health=df["health"].astype("category"),
+        state=df["state"].astype("category"),
+        clients=pd.to_numeric(df["clients"], errors="coerce").fillna(0).astype("int32"),
+    )
+
+
+def _value_counts(series):
+    """Giống value_counts() nhưng các nhãn cùng số lượng xếp theo lần xuất hiện đầu tiên (như pipeline Mongo)."""
+    codes = series.cat.codes.to_numpy()
+    codes = codes[codes >= 0]
+    if not len(codes):
+        return []
+    uniq, first = np.unique(codes, return_index=True)
+    counts = np.bincount(codes)[uniq]
+    labels = series.cat.categories
+    return [{"name": str(labels[uniq[i]]), "value": int(counts[i])} for i in np.lexsort((first, -counts))]
+
+
+def _lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: chọn n_out điểm giữ hình dạng chuỗi (luôn giữ điểm đầu và cuối)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = [0]
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Điểm đại diện của bucket kế tiếp: trung bình (bucket cuối là điểm cuối cùng)
+        nxt_start, nxt_end = end, (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x, avg_y = x[nxt_start:nxt_end].mean(), y[nxt_start:nxt_end].mean()
+        a = keep[-1]
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        keep.append(start + int(area.argmax()))
+    keep.append(n - 1)
+    return np.array(keep)
+
+
+def downsample_series(points, max_points=None, bucket_minutes=None):
+    """Giảm số điểm của chuỗi clients [{"time", "clients"}] trước khi trả về frontend.
+
+    bucket_minutes: gom theo khoảng cố định, mỗi khoảng lấy MAX (đỉnh) của tổng clients theo phút.
+    max_points: nếu vẫn nhiều điểm hơn thì chọn lại bằng LTTB để giữ hình dạng biểu đồ.
+    """
+    if not points or (not max_points and not bucket_minutes):
+        return points
+    times = pd.to_datetime([p["time"] for p in points], format="%Y-%m-%d %H:%M")
+    clients = pd.Series([p["clients"] for p in points], index=times)
+
+    if bucket_minutes and bucket_minutes > 1:
+        clients = clients.groupby(clients.index.floor(f"{int(bucket_minutes)}min")).max()
+    if max_points and len(clients) > max_points:
+        x = clients.index.asi8.astype("float64")
+        idx = _lttb(x, clients.to_numpy(dtype="float64"), int(max_points))
+        clients = clients.iloc[idx]
+    return [{"time": t.strftime("%Y-%m-%d %H:%M"), "clients": int(c)} for t, c in clients.items()]
+
+
+async def _iter_files(file_list):
+    """Nhận list (bytes, filename) hoặc async generator (luồng tải từ R2)."""
+    if hasattr(file_list, "__aiter__"):
+        async for item in file_list:
+            yield item
+    else:
+        for item in file_list:
+            yield item
+
+
+def _rollup_key(device):
+    """Tên device dùng làm tên field trong client_rollups ('.' và '$' không hợp lệ trong đường dẫn field)."""
+    return device.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def _series_point(r):
+    """Kết quả _clients_series_pipeline -> một điểm {"time", "clients"}."""
+    return {"time": r["_id"].strftime("%Y-%m-%d %H:%M"), "clients": int(r["clients"])}
+
+
+def _distribution_point(r):
+    """Kết quả _distribution_pipeline -> một điểm {"name", "value"}."""
+    return {"name": str(r["_id"]), "value": int(r["count"])}
+
+
+# Engine đọc .xlsx: "calamine" (Rust, cần gói python-calamine) nhanh hơn openpyxl nhiều lần.
+# Mặc định dùng calamine nếu đã cài, không thì openpyxl như trước.
+XLSX_ENGINE = os.getenv("XLSX_ENGINE") or ("calamine" if importlib.util.find_spec("python_calamine") else "openpyxl")
+
+# Các cột process_file_data dùng (tên sau khi strip + title); file export có nhiều cột khác không cần đọc
+USED_COLUMNS = {"Device", "Name", "Clients", "Health", "State", "Model", "Ip Address", "Ip"}
+
+
+def _used_column(name):
+    return str(name).strip().title() in USED_COLUMNS
+
+
+def _read_csv(file_source):
+    return pd.read_csv(file_source, usecols=_used_column)
+
+
+def _read_excel(file_source, engine=None):
+    """Đọc sheet đầu tiên bằng XLSX_ENGINE; lỗi thì đọc lại bằng openpyxl (engine mặc định trước đây)."""
+    engine = engine or XLSX_ENGINE
+    try:
+        return pd.read_excel(file_source, engine=engine, usecols=_used_column)
+    except Exception:
+        if engine == "openpyxl" or not hasattr(file_source, "seek"):
+            raise
+        file_source.seek(0)
+        return pd.read_excel(file_source, engine="openpyxl", usecols=_used_column)
+
+
+# Hàm đọc theo phần mở rộng file; phần mở rộng khác đọc như Excel (giống trước đây)
+READERS = {".csv": _read_csv, ".xlsx": _read_excel}
+
+
+def read_report_frame(file_source, fname):
+    """DataFrame các cột cần dùng của một file export, tên cột đã strip + title."""
+    reader = READERS.get(os.path.splitext(fname)[1].lower(), _read_excel)
+    df = reader(file_source)
+    df.columns = [str(c).strip().title() for c in df.columns]
+    return df
+
+
+def content_hash(content, fname):
+    """sha256 của snapshot (site, thời điểm trong tên file) + nội dung file, để nhận ra cùng một snapshot được upload lại dưới tên khác.
+
+    Site / thời điểm của records lấy từ tên file nên hai file cùng nội dung nhưng khác snapshot không bị coi là trùng.
+    """
+    if not isinstance(content, (bytes, bytearray)):
+        return None
+    meta = parse_filename(fname)
+    digest = hashlib.sha256(f"{meta.site}|{meta.dt_obj.isoformat() if meta.dt_obj else ''}|".encode())
+    digest.update(content)
+    return digest.hexdigest()
+
+
+def _merge_duplicate_keys(records):
+    """Gộp các records trùng khoá (site, device, dt_obj) trong cùng lô: clients lấy MAX, các field khác lấy bản sau cùng."""
+    merged = {}
+    for r in records:
+        key = (r["site"], r["device"], r["dt_obj"])
+        old = merged.get(key)
+        if old is not None:
+            r = {**r, "clients": max(old.get("clients") or 0, r.get("clients") or 0)}
+        merged[key] = r
+    return list(merged.values()) if len(merged) < len(records) else records
+
+
+def parse_file(content, fname):
+    """Parse một file đã tải về (bytes) thành records. Hàm top-level để chạy được trong process pool."""
+    file_source = BytesIO(content) if isinstance(content, bytes) else content
+    return AnalyzerEngine.process_file_data(file_source, fname)
+
+
+# Số process dùng để parse file (0 = parse trong thread mặc định, không dùng process pool)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1))
+# Số file tối đa đang parse / chờ ghi DB cùng lúc (giới hạn RAM và tạo backpressure)
+PARSE_QUEUE_SIZE = int(os.getenv("PARSE_QUEUE_SIZE", max(PARSE_WORKERS, 1) * 2))
+# Số file kiểm tra trùng trong một query $in
+INGEST_DEDUP_BATCH = int(os.getenv("INGEST_DEDUP_BATCH", 32))
+# Số records tối đa gom lại cho một lần insert_many
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 20000))
+
+# "mongo": biểu đồ được tính bằng aggregation pipeline trên MongoDB, chỉ trả về các điểm kết quả
+# "pandas": tải records thô về rồi tính bằng pandas (cách cũ, tối đa 100k bản ghi)
+ANALYZE_BACKEND = os.getenv("ANALYZE_BACKEND", "mongo")
+
+# Số bản ghi tối đa filter_data đọc về một lần (xuất toàn bộ thì dùng iter_records / /api/export/records)
+FILTER_DATA_LIMIT = int(os.getenv("FILTER_DATA_LIMIT", 100000))
+# Số bản ghi mỗi lần iter_records trả về khi xuất dữ liệu dạng stream
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 5000))
+
+# Các field filter_data đọc về; index (site, dt_obj, device, clients, health, state) chứa đủ nên query được "covered"
+RECORD_FIELDS = {"dt_obj": 1, "clients": 1, "health": 1, "state": 1, "site": 1, "device": 1, "_id": 0}
+
 
 class AnalyzerEngine:
     def __init__(self):
-        # Khởi tạo indexes khi engine được load
-        pass
+        # Process pool để parse file, chỉ tạo khi sync lần đầu
+        self._parse_pool = None
+        # Cache cho sites/devices/summary, bị xoá mỗi khi có dữ liệu mới
+        self.cache = TTLCache()
+        # Records của HOT_CACHE_HOURS giờ gần nhất dạng Arrow cho filter_data
+        self.hot = HotWindowCache()
+        # Gọi mỗi khi dữ liệu thay đổi (sau khi ghi / xoá), main.py dùng để báo cho dashboard qua SSE
+        self.on_data_changed = None
+
+    def _get_parse_pool(self):
+        """Tạo process pool lần đầu cần dùng. Dùng "spawn" vì process cha đang có thread của Motor."""
+        if self._parse_pool is None and PARSE_WORKERS > 0:
+            self._parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._parse_pool
+
+    def shutdown(self):
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=False, cancel_futures=True)
+            self._parse_pool = None
 
-    async def load_multiple_from_memory(self, file_list):
-        """Xử lý nhiều file và lưu vào MongoDB."""
+    async def load_multiple_from_memory(self, file_list, on_progress=None):
+        """Xử lý nhiều file và lưu vào MongoDB. file_list có thể là list hoặc async generator.
+
+        File được parse trên process pool (PARSE_WORKERS), tối đa PARSE_QUEUE_SIZE file chờ cùng lúc;
+        event loop chỉ làm việc ghi MongoDB nên API vẫn phản hồi trong lúc sync.
+        Records của nhiều file được gom lại và ghi theo lô (xem _write_batch).
+        on_progress(files_parsed, records_written) được gọi sau mỗi file và mỗi lần ghi.
+        """
         new_records_count = 0
+        files_parsed = 0
         skipped_files = []
-        
-        for content, fname in file_list:
-            # 1. Kiểm tra xem file đã được xử lý chưa
-            existing = await files_collection.find_one({"filename": fname})
-            if existing:
-                continue
-            
+
+        def report():
+            if on_progress:
+                on_progress(files_parsed, new_records_count)
+        loop = asyncio.get_running_loop()
+        pool = self._get_parse_pool()
+        queue = asyncio.Queue(maxsize=PARSE_QUEUE_SIZE)
+
+        async def submit_parse_jobs():
+            seen, seen_hashes = set(), set()
+
+            async def submit(chunk):
+                # 1. Kiểm tra file đã xử lý (theo tên hoặc cùng snapshot + nội dung): một query $in cho cả lô thay vì find_one từng file
+                names = [fname for _, fname in chunk]
+                hashes = await asyncio.to_thread(lambda: [content_hash(content, fname) for content, fname in chunk])
+                processed = set(await files_collection.distinct("filename", {"filename": {"$in": names}}))
+                seen_hashes.update(await files_collection.distinct("content_hash", {"content_hash": {"$in": [h for h in hashes if h]}}))
+                duplicates = []
+                for (content, fname), digest in zip(chunk, hashes):
+                    if fname in processed or fname in seen:
+                        continue
+                    seen.add(fname)
+                    if digest in seen_hashes:
+                        duplicates.append(UpdateOne({"filename": fname}, {"$setOnInsert": {"processed_at": datetime.utcnow()},
+                                                                          "$set": {"content_hash": digest}}, upsert=True))
+                        skipped_files.append(f"{fname} (Duplicate content)")
+                        continue
+                    if digest:
+                        seen_hashes.add(digest)
+                    # put() sẽ chờ khi hàng đợi đầy -> không đẩy quá nhiều file vào pool
+                    await queue.put((fname, digest, loop.run_in_executor(pool, parse_file, content, fname)))
+                # File trùng nội dung với file đã xử lý: không parse, chỉ đánh dấu tên file là đã xử lý
+                if duplicates:
+                    await files_collection.bulk_write(duplicates, ordered=False)
+
+            cancelled = False
             try:
-                file_source = BytesIO(content) if isinstance(content, bytes) else content
-                records_data = self.process_file_data(file_source, fname)
-                
+                chunk = []
+                async for item in _iter_files(file_list):
+                    chunk.append(item)
+                    if len(chunk) >= INGEST_DEDUP_BATCH:
+                        await submit(chunk)
+                        chunk = []
+                if chunk:
+                    await submit(chunk)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # Bị huỷ nghĩa là consumer đã dừng: không ai đọc hàng đợi nữa, put() sẽ chờ mãi nếu đang đầy
+                if not cancelled:
+                    await queue.put(None)
+
+        batch_records, batch_files = [], {}
+
+        async def flush():
+            nonlocal new_records_count
+            if not batch_files:
+                return
+            try:
+                new_records_count += await self._write_batch(batch_records, batch_files)
+            except Exception as e:
+                print(f"Error saving {len(batch_files)} files: {e}")
+                skipped_files.extend(f"{f} (Error)" for f in batch_files)
+            batch_records.clear()
+            batch_files.clear()
+            report()
+
+        producer = asyncio.create_task(submit_parse_jobs())
+        try:
+            while (item := await queue.get()) is not None:
+                fname, digest, parse_job = item
+                files_parsed += 1
+                try:
+                    records_data = await parse_job
+                except BrokenProcessPool:
+                    # Worker bị kill (vd. hết RAM): bỏ pool hỏng để lần sync sau tạo pool mới
+                    self.shutdown()
+                    raise
+                except Exception as e:
+                    print(f"Error processing {fname}: {e}")
+                    skipped_files.append(f"{fname} (Error)")
+                    report()
+                    continue
+
                 if records_data:
-                    # 2. Insert toàn bộ records của file vào MongoDB
-                    await reports_collection.insert_many(records_data)
-                    
-                    # 3. Đánh dấu file đã xử lý
-                    await files_collection.insert_one({
-                        "filename": fname,
-                        "processed_at": datetime.utcnow()
-                    })
-                    new_records_count += len(records_data)
+                    batch_records.extend(records_data)
+                    batch_files[fname] = digest
                 else:
                     skipped_files.append(f"{fname} (No records)")
-                    
-            except Exception as e:
-                print(f"Error processing {fname}: {e}")
-                skipped_files.append(f"{fname} (Error)")
+                report()
+
+                # 2. Ghi khi lô đủ lớn, hoặc khi không còn file nào chờ (không để dữ liệu nằm trong RAM lúc rảnh)
+                if len(batch_records) >= INSERT_BATCH_SIZE or queue.empty():
+                    await flush()
+            await producer
+            await flush()
+        finally:
+            if not producer.done():
+                # Chờ producer dừng hẳn để nó không giữ file_list (generator tải R2 và nội dung file) sau khi hàm này kết thúc
+                producer.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await producer
+            # Bỏ các file đã đưa vào pool nhưng chưa được đọc kết quả
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[2].cancel()
+                    item[2].add_done_callback(lambda f: f.cancelled() or f.exception())
 
         print(f"Sync complete. Added {new_records_count} records to MongoDB.")
         return new_records_count, skipped_files
 
-    def process_file_data(self, file_source, fname):
-        """Logic phân tích file Excel/CSV thành list các dict cho MongoDB."""
-        all_records = []
-        date_time_pattern = re.compile(r"(\d{1,4}[-.\/]\d{1,2}[-.\/]\d{1,4})")
-        time_pattern = re.compile(r"(\d{1,2}[h:]\d{1,2})")
-
-        site_name = "Unknown"
-        dt_obj = None
-
-        date_match = date_time_pattern.search(fname)
-        time_match = time_pattern.search(fname)
-
-        if date_match and time_match:
-            date_str = date_match.group(1).replace('.', '-').replace('/', '-')
-            time_str = time_match.group(1).replace('h', ':')
-            site_part = fname[:date_match.start()].strip(" -_")
-            if site_part: site_name = site_part
-            for fmt in ["%d-%m-%Y %H:%M", "%Y-%m-%d %H:%M"]:
-                try:
-                    dt_obj = datetime.strptime(f"{date_str} {time_str}", fmt)
-                    break
-                except: continue
-        
-        if not dt_obj:
-            dt_obj = datetime.now()
-            site_part = fname.split('-')[0].strip() if '-' in fname else "Unknown"
-            if site_part and site_part != fname: site_name = site_part
+    async def _write_batch(self, records, files):
+        """Ghi records của một lô file rồi đánh dấu các file ({filename: content_hash}) bằng một bulk upsert.
 
-        df = pd.read_csv(file_source) if fname.endswith('.csv') else pd.read_excel(file_source)
-        df.columns = [str(c).strip().title() for c in df.columns] 
-        
-        for _, row in df.iterrows():
-            dev = str(row.get("Device", row.get("Name", ""))).strip()
-            if not dev or dev.lower() in ["device", "nan", ""]: continue
-            
-            try: client_count = int(float(row.get("Clients", 0)))
-            except: client_count = 0
-                
-            all_records.append({
-                "dt_obj": dt_obj,
-                "site": site_name,
-                "device": str(dev),
-                "clients": client_count,
-                "health": str(row.get("Health", "")),
-                "state": str(row.get("State", "")),
-                "model": str(row.get("Model", "")),
-                "ip": str(row.get("Ip Address", "") or row.get("Ip", ""))
-            })
-        return all_records
+        Trả về số records mới (records trùng dữ liệu đã có không được tính).
+        """
+        new_count = await self._insert_records(records)
 
+        # 3. Đánh dấu file đã xử lý
+        processed_at = datetime.utcnow()
+        await files_collection.bulk_write([
+            UpdateOne({"filename": f}, {"$setOnInsert": {"processed_at": processed_at}, "$set": {"content_hash": digest}}, upsert=True)
+            for f, digest in files.items()
+        ], ordered=False)
+        return new_count
+
+    async def _insert_records(self, records):
+        """Ghi records bằng insert_many không thứ tự; records là khoá duy nhất (site, device, dt_obj).
+
+        Bản ghi trùng khoá với dữ liệu đã có (sync lại sau clear-sync-cache, cùng snapshot trong file khác tên)
+        không tạo bản mới mà gộp vào bản cũ: clients lấy MAX, các field khác lấy bản sau cùng; giống hệt thì bỏ qua.
+        Nhờ vậy lúc phân tích không phải lọc trùng theo (site, device, phút) nữa. Trả về số records mới.
+        """
+        records = _merge_duplicate_keys(records)
+        if not records:
+            return 0
+        duplicates = []
+        try:
+            await reports_collection.insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            duplicates = [records[err["index"]] for err in errors]
+
+        changed = 0
+        if duplicates:
+            result = await reports_collection.bulk_write([
+                UpdateOne(
+                    {"site": r["site"], "device": r["device"], "dt_obj": r["dt_obj"]},
+                    {"$max": {"clients": r.get("clients") or 0},
+                     "$set": {k: v for k, v in r.items() if k not in ("_id", "site", "device", "dt_obj", "clients")}},
+                )
+                for r in duplicates
+            ], ordered=False)
+            changed = result.modified_count
+            skip = {id(r) for r in duplicates}
+            new_records = [r for r in records if id(r) not in skip]
+        else:
+            new_records = records
+
+        if changed:
+            # Bản trong cache đã bị gộp -> đọc lại cửa sổ từ MongoDB
+            self.hot.invalidate()
+        else:
+            self.hot.append(new_records)
+        if new_records or changed:
+            await self._update_derived(new_records + duplicates if changed else new_records)
+        return len(new_records)
+
+    async def _update_client_rollups(self, records):
+        """Cập nhật client_rollups: mỗi (site, phút) lưu max clients của từng device và tổng của chúng.
+
+        Giống cách /api/analyze tính trước đây: lấy MAX nếu cùng site/device/phút rồi cộng theo phút.
+        """
+        buckets = {}
+        for r in records:
+            key = (str(r["site"]).strip(), r["dt_obj"].replace(second=0, microsecond=0))
+            devices = buckets.setdefault(key, {})
+            dev = _rollup_key(str(r["device"]).strip())
+            clients = r.get("clients") or 0
+            if dev not in devices or devices[dev] < clients:
+                devices[dev] = clients
+        if not buckets:
+            return
+
+        # $max để ghi lại cùng một phút (file upload lại, sync song song) vẫn cho kết quả đúng
+        await client_rollups_collection.bulk_write([
+            UpdateOne({"site": site, "bucket": bucket},
+                      {"$max": {f"devices.{dev}": clients for dev, clients in devices.items()}},
+                      upsert=True)
+            for (site, bucket), devices in buckets.items()
+        ], ordered=False)
+        # Tính lại tổng clients của các phút vừa cập nhật
+        sites = list({site for site, _ in buckets})
+        times = list({bucket for _, bucket in buckets})
+        await client_rollups_collection.update_many(
+            {"site": {"$in": sites}, "bucket": {"$in": times}}, ROLLUP_TOTAL
+        )
+
+    async def _update_device_latest(self, records):
+        """Upsert trạng thái của từng (site, device) nếu snapshot mới hơn bản đang lưu.
+
+        Tính sẵn is_up / low_health để get_global_summary chỉ còn một phép $group.
+        """
+        latest = {}
+        for r in records:
+            key = (str(r["site"]).strip(), str(r["device"]).strip())
+            if key not in latest or latest[key]["dt_obj"] <= r["dt_obj"]:
+                latest[key] = r
+        if not latest:
+            return
+
+        ops = []
+        for (site, device), r in latest.items():
+            state = str(r.get("state", "")).lower().strip()
+            health_str = str(r.get("health", "100")).replace("%", "").strip()
+            try: low_health = float(health_str) < 70
+            except: low_health = False
+            clients = r.get("clients") or 0
+            # Điều kiện dt_obj <= mới: bản đang lưu mới hơn thì upsert bị trùng khóa và được bỏ qua.
+            # Cùng snapshot (file được ghi đè / upload lại) thì cập nhật như records: state/health mới, clients lấy MAX
+            ops.append(UpdateOne(
+                {"site": site, "device": device, "dt_obj": {"$lte": r["dt_obj"]}},
+                [{"$set": {
+                    "clients": {"$cond": [{"$eq": ["$dt_obj", r["dt_obj"]]}, {"$max": ["$clients", clients]}, clients]},
+                    "dt_obj": r["dt_obj"],
+                    "health": {"$literal": r.get("health")},
+                    "state": {"$literal": r.get("state")},
+                    "is_up": state in UP_STATES,
+                    "low_health": low_health,
+                }}],
+                upsert=True,
+            ))
+        try:
+            await device_latest_collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    async def _update_derived(self, records):
+        """Cập nhật các bảng tổng hợp (client_rollups, device_latest) từ records vừa ghi."""
+        await self._update_client_rollups(records)
+        await self._update_device_latest(records)
+        await mark_dirty(records)
+        self.notify_data_changed()
+
+    def notify_data_changed(self):
+        """Xoá cache kết quả và báo cho nơi đăng ký on_data_changed."""
+        self.cache.invalidate()
+        if self.on_data_changed:
+            self.on_data_changed()
+
+    async def rebuild_derived(self):
+        """Tạo lại client_rollups và device_latest từ toàn bộ records (dữ liệu có từ trước khi có các bảng này).
+
+        Khi bật retention, records thô cũ đã bị xoá nên chỉ tính lại phần rollup còn records thô, giữ nguyên phần cũ hơn.
+        """
+        if RETENTION_ENABLED:
+            oldest = await reports_collection.find_one({}, {"dt_obj": 1}, sort=[("dt_obj", 1)])
+            if oldest:
+                await client_rollups_collection.delete_many({"bucket": {"$gte": oldest["dt_obj"].replace(second=0, microsecond=0)}})
+        else:
+            await client_rollups_collection.delete_many({})
+            await device_latest_collection.delete_many({})
+        cursor = reports_collection.find({}, {"_id": 0})
+        chunk = []
+        async for r in cursor.batch_size(INSERT_BATCH_SIZE):
+            chunk.append(r)
+            if len(chunk) >= INSERT_BATCH_SIZE:
+                await self._update_derived(chunk)
+                chunk = []
+        await self._update_derived(chunk)
+
+    async def derived_missing(self):
+        """True nếu đã có records nhưng các bảng tổng hợp còn trống (cần rebuild)."""
+        for collection in [client_rollups_collection, device_latest_collection]:
+            if not await collection.find_one({}, {"_id": 1}):
+                return await reports_collection.find_one({}, {"_id": 1}) is not None
+        return False
+
+    async def analyze_metric(self, sites, device, metric, hours=None, mode=None, max_points=None, bucket_minutes=None):
+        """Dữ liệu biểu đồ cho một metric (clients, health, state). sites=None nghĩa là tất cả site.
+
+        mode mặc định theo ANALYZE_BACKEND; hai chế độ cho cùng kết quả (xem bench_analyze.py).
+        max_points / bucket_minutes chỉ áp dụng cho chuỗi thời gian clients (xem downsample_series).
+        """
+        if (mode or ANALYZE_BACKEND) == "pandas":
+            if sites is None:
+                df = await self.filter_data("All Sites", device, hours)
+            else:
+                df = await self.filter_data_multiple(sites, device, hours)
+            result = self.metric_from_frame(df, metric)
+            return downsample_series(result, max_points, bucket_minutes) if metric == "clients" else result
+
+        if metric == "clients":
+            series = await self.get_clients_series(sites, device, hours)
+            return downsample_series(series, max_points, bucket_minutes)
+        if metric in ["health", "state"]:
+            return await self._aggregate_distribution(sites, device, metric, hours)
+        return []
+
+    async def iter_metric(self, sites, device, metric, hours=None, max_points=None, bucket_minutes=None,
+                          batch_size=EXPORT_BATCH_SIZE):
+        """Như analyze_metric nhưng trả về dần từng list batch_size điểm, đọc từ cursor aggregation.
+
+        Chế độ pandas và chuỗi clients có max_points / bucket_minutes cần cả chuỗi nên vẫn tính hết rồi chia batch.
+        """
+        streamable = metric in ["health", "state"] or (metric == "clients" and not (max_points or bucket_minutes))
+        if ANALYZE_BACKEND == "pandas" or not streamable:
+            rows = await self.analyze_metric(sites, device, metric, hours, max_points=max_points, bucket_minutes=bucket_minutes)
+            for i in range(0, len(rows), batch_size):
+                yield rows[i:i + batch_size]
+            return
+
+        if metric == "clients":
+            collection, pipeline = await window_pipeline(hours, self._clients_series_pipeline(sites, device, hours), rollups=True)
+            point = _series_point
+        else:
+            collection, pipeline = await window_pipeline(hours, self._distribution_pipeline(sites, device, metric, hours))
+            point = _distribution_point
+        cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+        batch = []
+        async for r in cursor:
+            batch.append(point(r))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def analyze_batch(self, queries, mode=None):
+        """Tính nhiều biểu đồ một lần (cả dashboard). queries: list dict sites/device/metric/hours/max_points/bucket_minutes.
+
+        Chế độ mongo: các widget trùng (sites, device, metric, hours) chỉ tính một lần, còn lại chạy song song.
+        Chế độ pandas: các widget cùng danh sách site dùng chung một lần đọc records (khoảng thời gian dài nhất),
+        mỗi widget lọc device / thời gian trên DataFrame đó.
+        """
+        if (mode or ANALYZE_BACKEND) == "pandas":
+            series = await self._batch_from_frames(queries)
+        else:
+            tasks = {}
+            for q in queries:
+                key = (_freeze(q["sites"]), q["device"], q["metric"], q["hours"])
+                if key not in tasks:
+                    tasks[key] = asyncio.ensure_future(self.analyze_metric(q["sites"], q["device"], q["metric"], q["hours"], mode="mongo"))
+            await asyncio.gather(*tasks.values())
+            series = [tasks[(_freeze(q["sites"]), q["device"], q["metric"], q["hours"])].result() for q in queries]
+
+        return [
+            downsample_series(data, q.get("max_points"), q.get("bucket_minutes")) if q["metric"] == "clients" else data
+            for q, data in zip(queries, series)
+        ]
+
+    async def _batch_from_frames(self, queries):
+        groups = {}
+        for i, q in enumerate(queries):
+            groups.setdefault(_freeze(q["sites"]), []).append(i)
+
+        results = [None] * len(queries)
+        for indexes in groups.values():
+            group = [queries[i] for i in indexes]
+            sites = group[0]["sites"]
+            hours = None if any(not q["hours"] for q in group) else max(q["hours"] for q in group)
+            devices = {q["device"] for q in group}
+            device = devices.pop() if len(devices) == 1 else "All Devices"
+            if sites is None:
+                df = await self.filter_data("All Sites", device, hours)
+            else:
+                df = await self.filter_data_multiple(sites, device, hours)
+            # Lần đọc chung bị cắt ở FILTER_DATA_LIMIT: widget hẹp hơn có thể mất dữ liệu mà tự đọc thì có -> đọc riêng
+            truncated = len(df) >= FILTER_DATA_LIMIT
+
+            for i, q in zip(indexes, group):
+                if truncated and (q["device"] != device or q["hours"] != hours):
+                    results[i] = await self.analyze_metric(q["sites"], q["device"], q["metric"], q["hours"], mode="pandas")
+                    continue
+                part = df
+                if not part.empty and q["device"] != device:
+                    part = part[part["device"] == q["device"]]
+                if not part.empty and q["hours"] and q["hours"] != hours:
+                    part = part[part["dt_obj"] >= datetime.now() - timedelta(hours=q["hours"])]
+                results[i] = self.metric_from_frame(part, q["metric"])
+        return results
+
+    @staticmethod
+    def metric_from_frame(df, metric):
+        """Tính dữ liệu biểu đồ từ DataFrame records bằng pandas (filter_data đã trả về dtype gọn)."""
+        if df.empty: return []
+
+        # Không làm gì nếu đã là categorical đã strip; khoảng trắng đã được chuẩn hoá lúc ingest
+        df = compact_frame(df)
+        # Nhóm theo phút bằng dt.floor thay vì chuỗi strftime của từng dòng
+        df['minute'] = df['dt_obj'].dt.floor('min')
+
+        # Mỗi (site, device, dt_obj) chỉ có một bản ghi (unique index, gộp lúc ingest) nên không cần lọc trùng
+        result_data = []
+        if metric == "clients":
+            # Cộng tổng clients của tất cả thiết bị trong phút đó
+            chart_data = df.groupby('minute')['clients'].sum().sort_index()
+            result_data = [{"time": t.strftime("%Y-%m-%d %H:%M"), "clients": int(c)} for t, c in chart_data.items()]
+
+        elif metric in ["health", "state"]:
+            # Theo thứ tự thời gian để các nhãn cùng số lượng xếp giống pipeline Mongo
+            if not df['dt_obj'].is_monotonic_increasing:
+                df = df.sort_values('dt_obj', kind='stable')
+            result_data = _value_counts(df[metric])
+        return result_data
+
+    @staticmethod
+    def _site_time_query(sites, hours, time_field):
+        query = {}
+        if sites is not None: query["site"] = {"$in": sites}
+        if hours:
+            query[time_field] = {"$gte": datetime.now() - timedelta(hours=hours)}
+        return query
+
+    @staticmethod
+    def _records_query(site_filter, device, hours):
+        """Query cho records: site_filter là tên site, {"$in": [...]} hoặc None (tất cả site)."""
+        query = {}
+        if site_filter is not None: query["site"] = site_filter
+        if device != "All Devices": query["device"] = device
+        if hours:
+            # Lấy theo thời gian hiện tại trừ đi số giờ
+            query["dt_obj"] = {"$gte": datetime.now() - timedelta(hours=hours)}
+        return query
+
+    @classmethod
+    def _distribution_pipeline(cls, sites, device, metric, hours=None):
+        query = cls._site_time_query(sites, hours, "dt_obj")
+        if device != "All Devices": query["device"] = device
+        query[metric] = {"$ne": None}
+        # Records không trùng (site, device, dt_obj) nên đếm thẳng, không cần $sort + $group theo từng thiết bị / phút
+        return [
+            {"$match": query},
+            # "first": lần xuất hiện đầu tiên của nhãn, để các nhãn bằng số lượng xếp giống value_counts()
+            {"$group": {"_id": f"${metric}", "count": {"$sum": 1}, "first": {"$min": {"t": "$dt_obj", "id": "$_id"}}}},
+            {"$sort": {"count": -1, "first.t": 1, "first.id": 1}},
+        ]
+
+    async def _aggregate_distribution(self, sites, device, metric, hours=None):
+        """Phân bố health/state bằng aggregation pipeline, cùng kết quả với metric_from_frame."""
+        collection, pipeline = await window_pipeline(hours, self._distribution_pipeline(sites, device, metric, hours))
+        cursor = collection.aggregate(pipeline, allowDiskUse=True)
+        return [_distribution_point(r) async for r in cursor]
+
+    @classmethod
+    def _clients_series_pipeline(cls, sites, device, hours=None):
+        query = cls._site_time_query(sites, hours, "bucket")
+
+        value = "$total"
+        if device != "All Devices":
+            field = f"devices.{_rollup_key(device.strip())}"
+            query[field] = {"$exists": True}
+            value = f"${field}"
+
+        return [
+            {"$match": query},
+            {"$group": {"_id": "$bucket", "clients": {"$sum": value}}},
+            {"$sort": {"_id": 1}},
+        ]
+
+    async def get_clients_series(self, sites, device, hours=None):
+        """Chuỗi tổng clients theo phút cho biểu đồ, đọc từ client_rollups (theo 15 phút / 1 giờ nếu khoảng dài hơn tầng thô).
+
+        sites=None nghĩa là tất cả site. Chi phí phụ thuộc số bucket trong khoảng thời gian, không phụ thuộc số records.
+        """
+        collection, pipeline = await window_pipeline(hours, self._clients_series_pipeline(sites, device, hours), rollups=True)
+        cursor = collection.aggregate(pipeline)
+        return [_series_point(r) async for r in cursor]
+
+    @staticmethod
+    def process_file_data(file_source, fname):
+        """Logic phân tích file Excel/CSV thành list các dict cho MongoDB."""
+        meta = parse_filename(fname)
+        dt_obj = snapshot_time(meta, fname)
+        if dt_obj is None:
+            # Không gán datetime.now(): records sẽ nằm sai thời điểm và làm lệch rollup
+            raise ValueError(f"No snapshot date/time in filename {fname!r} (formats: {FILENAME_DATE_FORMATS})")
+        site_name = meta.site
+        return records_from_frame(read_report_frame(file_source, fname), dt_obj, site_name)
+
+    @cached
     async def get_sites(self):
         sites = await reports_collection.distinct("site")
         return sorted(sites)
 
+    @cached
     async def get_devices(self, site=None):
         query = {"site": site} if site and site != "All Sites" else {}
         devices = await reports_collection.distinct("device", query)
         return sorted(devices)
 
+    @staticmethod
+    def _site_device_map_pipeline(sites=None):
+        pipeline = []
+        if sites is not None:
+            pipeline.append({"$match": {"site": {"$in": sites}}})
+        pipeline.append({"$group": {"_id": "$site", "devices": {"$addToSet": "$device"}}})
+        return pipeline
+
+    @cached
+    async def get_site_device_map(self, sites=None):
+        """{site: [devices]} cho tất cả site (hoặc các site trong `sites`) bằng một aggregation trên device_latest.
+
+        device_latest có đúng một document cho mỗi (site, device) nên đóng vai trò danh mục thiết bị,
+        không phải quét bảng records như distinct("device") theo từng site.
+        """
+        cursor = device_latest_collection.aggregate(self._site_device_map_pipeline(sites))
+        return {r["_id"]: sorted(r["devices"]) async for r in cursor}
+
     async def get_total_records_count(self):
         return await reports_collection.count_documents({})
 
     async def filter_data(self, site, device, hours=None):
-        """Lấy dữ liệu từ MongoDB cho biểu đồ."""
-        query = {}
-        if site != "All Sites": query["site"] = site
-        if device != "All Devices": query["device"] = device
-        
-        if hours:
-            from datetime import timedelta
-            # Lấy theo thời gian hiện tại trừ đi số giờ
-            start_time = datetime.now() - timedelta(hours=hours)
-            query["dt_obj"] = {"$gte": start_time}
-        
-        cursor = reports_collection.find(query, {"dt_obj": 1, "clients": 1, "health": 1, "state": 1, "site": 1, "device": 1, "_id": 0})
-        records = await cursor.to_list(length=100000) # Lấy tối đa 100k bản ghi
-        
+        """Lấy dữ liệu cho biểu đồ: khoảng gần đây từ cache Arrow trong bộ nhớ, còn lại từ MongoDB."""
+        site_filter = None if site == "All Sites" else site
+        df = await self.hot.query(site_filter, device, hours)
+        if df is not None:
+            return compact_frame(df)
+        query = self._records_query(site_filter, device, hours)
+
+        # Khoảng dài đọc từ bảng đã rút gọn (15 phút / 1 giờ) nếu bật retention
+        cursor = await find_window(hours, query, RECORD_FIELDS)
+        records = await cursor.to_list(length=FILTER_DATA_LIMIT)
+        if len(records) >= FILTER_DATA_LIMIT:
+            print(f"filter_data: kết quả bị cắt ở {FILTER_DATA_LIMIT} bản ghi (site={site}, device={device}, hours={hours})")
+
         if not records: return pd.DataFrame()
-        return pd.DataFrame(records)
+        return compact_frame(pd.DataFrame(records))
 
     async def filter_data_multiple(self, sites, device, hours=None):
         """Lọc dữ liệu cho danh sách nhiều site cùng lúc (dùng cho User bình thường)."""
-        query = {"site": {"$in": sites}}
-        if device != "All Devices": query["device"] = device
+        df = await self.hot.query({"$in": sites}, device, hours)
+        if df is not None:
+            return compact_frame(df)
+        query = self._records_query({"$in": sites}, device, hours)
+
+        # Khoảng dài đọc từ bảng đã rút gọn (15 phút / 1 giờ) nếu bật retention
+        cursor = await find_window(hours, query, RECORD_FIELDS)
+        records = await cursor.to_list(length=FILTER_DATA_LIMIT)
+        if len(records) >= FILTER_DATA_LIMIT:
+            print(f"filter_data_multiple: kết quả bị cắt ở {FILTER_DATA_LIMIT} bản ghi (sites={sites}, device={device}, hours={hours})")
 
-        if hours:
-            from datetime import timedelta
-            start_time = datetime.now() - timedelta(hours=hours)
-            query["dt_obj"] = {"$gte": start_time}
-        
-        cursor = reports_collection.find(query, {"dt_obj": 1, "clients": 1, "health": 1, "state": 1, "site": 1, "device": 1, "_id": 0})
-        records = await cursor.to_list(length=100000)
-        
         if not records: return pd.DataFrame()
-        return pd.DataFrame(records)
+        return compact_frame(pd.DataFrame(records))
 
-    async def get_global_summary(self, allowed_sites=None):
-        """Thống kê dựa trên 2000 bản ghi mới nhất trong hệ thống (Cực kỳ ổn định)."""
+    @staticmethod
+    def _global_summary_pipeline(allowed_sites=None):
         query = {}
         if allowed_sites:
             query["site"] = {"$in": allowed_sites}
-        
-        # Lấy 2000 bản ghi gần đây nhất, sắp xếp theo thời gian giảm dần
-        cursor = reports_collection.find(query).sort("dt_obj", -1).limit(2000)
-        results = await cursor.to_list(length=2000)
+        return [
+            {"$match": query},
+            {"$group": {
+                "_id": None,
+                "devices": {"$sum": 1},
+                "up": {"$sum": {"$cond": ["$is_up", 1, 0]}},
+                # Thiết bị đang up nhưng health < 70 cũng tính là cảnh báo
+                "low_health": {"$sum": {"$cond": [{"$and": ["$is_up", "$low_health"]}, 1, 0]}},
+                "clients": {"$sum": "$clients"},
+            }},
+        ]
+
+    async def iter_records(self, sites, device, hours=None, batch_size=EXPORT_BATCH_SIZE):
+        """Duyệt toàn bộ records (không giới hạn 100k) theo thời gian tăng dần, mỗi lần trả về một list batch_size bản ghi.
+
+        sites=None nghĩa là tất cả site. Bộ nhớ chỉ giữ một batch nên dùng được cho xuất hàng triệu bản ghi.
+        """
+        query = self._records_query(None if sites is None else {"$in": sites}, device, hours)
+        fields = {**RECORD_FIELDS, "model": 1, "ip": 1}
+        cursor = await find_window(hours, query, fields, sort="dt_obj", batch_size=batch_size)
+        batch = []
+        async for r in cursor:
+            batch.append(r)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @cached
+    async def get_global_summary(self, allowed_sites=None):
+        """Thống kê theo trạng thái mới nhất của từng thiết bị (bảng device_latest), tính bằng một aggregation."""
+        cursor = device_latest_collection.aggregate(self._global_summary_pipeline(allowed_sites))
+        results = await cursor.to_list(length=1)
         
         if not results:
             return {"connectivity": "0%", "alerts": 0, "total_clients": 0}
-            
-        # Group by Site + Device to get the LATEST state of each unique device
-        latest_states = {}
-        for r in results:
-            site = r.get('site', 'Unknown')
-            device = r.get('device', 'Unknown')
-            key = f"{site}_{device}"
-            
-            # Vì đã sort theo dt_obj DESC, nên bản ghi đầu tiên của mỗi key chính là bản ghi mới nhất
-            if key not in latest_states:
-                latest_states[key] = r
-
-        total_devs = len(latest_states)
-        up_devs = 0
-        total_alerts = 0
-        total_clients = 0
-        
-        # Các trạng thái hoạt động tốt
-        UP_STATES = ["up", "online", "connected", "good", "active", "normal", "stable", "1", "true"]
 
-        for r in latest_states.values():
-            state = str(r.get("state", "")).lower().strip()
-            health_str = str(r.get("health", "100")).replace("%", "").strip()
-            total_clients += (r.get("clients") or 0)
-            
-            is_up = state in UP_STATES
-            if is_up: 
-                up_devs += 1
-            else: 
-                total_alerts += 1
-                
-            try:
-                health_val = float(health_str)
-                if health_val < 70 and is_up: 
-                    total_alerts += 1
-            except: pass
-            
-        connectivity = (up_devs / total_devs * 100) if total_devs > 0 else 0
+        r = results[0]
+        total_alerts = (r["devices"] - r["up"]) + r["low_health"]
+        connectivity = (r["up"] / r["devices"] * 100) if r["devices"] > 0 else 0
         
         return {
             "connectivity": f"{connectivity:.1f}%",
             "alerts": total_alerts,
-            "total_clients": total_clients
+            "total_clients": r["clients"]
         }
 
     async def inject_test_data(self):
@@ -205,7 +933,8 @@ class AnalyzerEngine:
         import random
         
         test_records = []
-        now = datetime.now()
+        # Theo phút như snapshot thật: inject lại trong cùng phút thì trùng khoá và được bỏ qua
+        now = datetime.now().replace(second=0, microsecond=0)
         sites = ["TEST_SITE_A", "TEST_SITE_B", "DEMO_LAB"]
         
         for site in sites:
@@ -226,8 +955,7 @@ class AnalyzerEngine:
                     })
         
         if test_records:
-            await reports_collection.insert_many(test_records)
-            return len(test_records)
+            return await self._insert_records(test_records)
         return 0
 
     async def clear_test_data(self):
@@ -240,4 +968,11 @@ class AnalyzerEngine:
                 {"site": {"$in": test_sites}}
             ]
         })
+        await client_rollups_collection.delete_many({"site": {"$in": test_sites}})
+        await device_latest_collection.delete_many({"site": {"$in": test_sites}})
+        for tier in TIERS[1:]:
+            await tier["collection"].delete_many({"site": {"$in": test_sites}})
+            await tier["rollups"].delete_many({"site": {"$in": test_sites}})
+        self.hot.invalidate()
+        self.notify_data_changed()
         return result.deleted_count
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+
+# Số event tối đa chờ gửi cho mỗi client; client chậm thì bỏ event cũ nhất
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", 100))
+# Gửi comment giữ kết nối SSE sau mỗi khoảng này (giây) nếu không có event
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", 15))
+# Gộp các lần ghi dữ liệu liên tiếp (mỗi batch một lần) thành một event data_changed
+DATA_CHANGED_DEBOUNCE_SECONDS = float(os.getenv("DATA_CHANGED_DEBOUNCE_SECONDS", 2))
+# Khoảng tối thiểu giữa hai event data_changed (giây): lúc sync bù dữ liệu, mỗi file là một lần ghi
+# và mỗi event làm mọi dashboard đang mở tải lại toàn bộ biểu đồ
+DATA_CHANGED_MIN_INTERVAL_SECONDS = float(os.getenv("DATA_CHANGED_MIN_INTERVAL_SECONDS", 30))
+
+
+class EventBroker:
+    """Phát event (tiến độ sync, dữ liệu thay đổi) tới các client đang nghe qua Server-Sent Events."""
+
+    def __init__(self, queue_size=EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._pending_data_changed = None
+        self._last_data_changed = None
+
+    def publish(self, event, data):
+        for queue in list(self._subscribers):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+
+    def publish_data_changed(self, delay=DATA_CHANGED_DEBOUNCE_SECONDS, min_interval=DATA_CHANGED_MIN_INTERVAL_SECONDS):
+        """data_changed được gửi sau `delay` giây và cách event trước ít nhất `min_interval` giây;
+        các lần gọi trong lúc chờ gộp vào cùng một event."""
+        if self._pending_data_changed is not None and not self._pending_data_changed.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Không chạy trong event loop (script, test) -> không có ai nghe
+            self._pending_data_changed = None
+            return
+
+        wait = delay
+        if self._last_data_changed is not None:
+            wait = max(wait, self._last_data_changed + min_interval - loop.time())
+
+        async def send_later():
+            await asyncio.sleep(wait)
+            self._last_data_changed = loop.time()
+            self.publish("data_changed", {})
+
+        self._pending_data_changed = loop.create_task(send_later())
+
+    async def stream(self, initial=None):
+        """Generator các đoạn text/event-stream cho một client, bắt đầu bằng các event trong `initial`."""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            for event, data in initial or []:
+                yield format_sse(event, data)
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, data)
+        finally:
+            self._subscribers.discard(queue)
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
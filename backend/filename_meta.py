@@ -0,0 +1,64 @@
+import logging
+import os
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+logger = logging.getLogger("filename_meta")
+
+# Định dạng "<ngày> <giờ>" trong tên file export, thử lần lượt (phân cách bằng ";")
+FILENAME_DATE_FORMATS = [f.strip() for f in os.getenv("FILENAME_DATE_FORMATS", "%d-%m-%Y %H:%M;%Y-%m-%d %H:%M").split(";") if f.strip()]
+# Số tên file / object key được nhớ kết quả parse (mỗi lần sync full liệt kê lại cả bucket)
+FILENAME_CACHE_SIZE = int(os.getenv("FILENAME_CACHE_SIZE", 65536))
+# File không có ngày giờ trong tên: "skip" (mặc định, không ingest) hoặc "now" (gán thời điểm ingest như trước đây)
+UNDATED_FILES = os.getenv("UNDATED_FILES", "skip").lower()
+
+DATE_PATTERN = re.compile(r"(\d{1,4}[-.\/]\d{1,2}[-.\/]\d{1,4})")
+TIME_PATTERN = re.compile(r"(\d{1,2}[h:]\d{1,2})")
+DATE_SEPARATORS = str.maketrans("./", "--")
+
+# dt_obj là thời điểm snapshot (theo phút), None nếu tên file không có ngày giờ hợp lệ
+FileMeta = namedtuple("FileMeta", ["site", "dt_obj"])
+
+
+@lru_cache(maxsize=FILENAME_CACHE_SIZE)
+def parse_filename(name):
+    """Site và thời điểm snapshot từ tên file "<site> - <ngày> <giờ>.csv" (hoặc object key R2, bỏ phần thư mục)."""
+    fname = os.path.basename(name)
+    date_match = DATE_PATTERN.search(fname)
+    time_match = TIME_PATTERN.search(fname)
+
+    site = "Unknown"
+    if date_match and time_match:
+        site = fname[:date_match.start()].strip(" -_") or site
+        stamp = f"{date_match.group(1).translate(DATE_SEPARATORS)} {time_match.group(1).replace('h', ':')}"
+        for fmt in FILENAME_DATE_FORMATS:
+            try:
+                return FileMeta(site, datetime.strptime(stamp, fmt))
+            except ValueError:
+                continue
+
+    # Không có ngày giờ hợp lệ: site là phần trước dấu "-" đầu tiên
+    prefix = fname.split('-')[0].strip() if '-' in fname else "Unknown"
+    if prefix and prefix != fname:
+        site = prefix
+    return FileMeta(site, None)
+
+
+def snapshot_time(meta, fname=None):
+    """Thời điểm gán cho records của file; None nếu không ingest được (tên file không có ngày giờ, UNDATED_FILES=skip)."""
+    if meta.dt_obj is not None:
+        return meta.dt_obj
+    if UNDATED_FILES == "now":
+        if fname:
+            logger.warning(f"No date/time in filename {fname!r}, using ingest time")
+        return datetime.now().replace(second=0, microsecond=0)
+    return None
+
+
+def within_hours(dt_obj, hours, now=None):
+    """True nếu thời điểm snapshot nằm trong `hours` giờ gần nhất (hours rỗng / 0 = không giới hạn)."""
+    if not hours:
+        return True
+    return dt_obj >= (now or datetime.now()) - timedelta(hours=hours)
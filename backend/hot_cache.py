@@ -0,0 +1,164 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from database_mongo import reports_collection
+
+# Số giờ gần nhất được giữ trong bộ nhớ dạng Arrow (0 = tắt)
+HOT_CACHE_HOURS = int(os.getenv("HOT_CACHE_HOURS", 48))
+# Sau khoảng này (giây) thì đọc lại toàn bộ từ MongoDB, phòng khi records được ghi từ process khác
+HOT_CACHE_MAX_AGE = float(os.getenv("HOT_CACHE_MAX_AGE", 3600))
+
+SCHEMA = pa.schema([
+    ("dt_obj", pa.timestamp("us")),
+    ("site", pa.string()),
+    ("device", pa.string()),
+    ("clients", pa.int32()),
+    ("health", pa.string()),
+    ("state", pa.string()),
+])
+
+
+def _to_table(records):
+    return pa.Table.from_pylist([{name: r.get(name) for name in SCHEMA.names} for r in records], schema=SCHEMA)
+
+
+class HotWindowCache:
+    """Records của HOT_CACHE_HOURS giờ gần nhất, mỗi site một Arrow table đã sort theo dt_obj.
+
+    filter_data lấy các khoảng thời gian nằm trong cửa sổ này từ đây (cắt theo thời gian bằng slice, không copy)
+    thay vì dựng DataFrame từ hàng trăm nghìn dict BSON. Khoảng dài hơn vẫn đọc từ MongoDB.
+    """
+
+    def __init__(self, hours=HOT_CACHE_HOURS, max_age=HOT_CACHE_MAX_AGE):
+        self.hours = hours
+        self.max_age = max_age
+        self._tables = {}      # site -> pa.Table
+        self._unsorted = set()  # site có dữ liệu append không theo thứ tự thời gian
+        self._loaded_at = None
+        self._loading = None    # records append trong lúc đang tải từ MongoDB
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def covers(self, hours):
+        return bool(self.hours) and bool(hours) and hours <= self.hours
+
+    def invalidate(self):
+        self._tables = {}
+        self._unsorted = set()
+        self._loaded_at = None
+        self._generation += 1
+
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.max_age
+
+    async def _ensure_loaded(self):
+        """Tải cửa sổ từ MongoDB nếu chưa có hoặc đã quá HOT_CACHE_MAX_AGE. False nếu không dùng được cache."""
+        if self._fresh():
+            return True
+        async with self._lock:
+            if self._fresh():
+                return True
+            generation = self._generation
+            self._loading = []
+            try:
+                since = datetime.now() - timedelta(hours=self.hours)
+                cursor = reports_collection.find({"dt_obj": {"$gte": since}}, {name: 1 for name in SCHEMA.names} | {"_id": 0})
+                records = await cursor.to_list(length=None)
+                # Records được ghi trong lúc đang đọc có thể đã nằm trong kết quả -> bỏ bản đọc từ MongoDB,
+                # vì metric_from_frame coi mỗi (site, device, dt_obj) chỉ có một bản ghi
+                if self._loading:
+                    written = {(r["site"], r["device"], r["dt_obj"]) for r in self._loading}
+                    records = [r for r in records if (r["site"], r["device"], r["dt_obj"]) not in written]
+                    records.extend(self._loading)
+            finally:
+                self._loading = None
+            # Bị invalidate (xoá dữ liệu) trong lúc đang đọc -> không dùng kết quả, lần sau đọc lại
+            if generation != self._generation:
+                return False
+            self._tables = {}
+            self._unsorted = set()
+            self._add(records)
+            self._loaded_at = time.monotonic()
+            return True
+
+    def _add(self, records):
+        by_site = {}
+        for r in records:
+            by_site.setdefault(r["site"], []).append(r)
+        for site, rows in by_site.items():
+            table = _to_table(rows)
+            old = self._tables.get(site)
+            if old is None:
+                self._unsorted.add(site)
+                self._tables[site] = table
+                continue
+            # Dữ liệu mới thường sau dữ liệu cũ -> chỉ nối thêm, không cần sort lại
+            if old.num_rows and pc.min(table["dt_obj"]).as_py() < pc.max(old["dt_obj"]).as_py():
+                self._unsorted.add(site)
+            self._tables[site] = pa.concat_tables([old, table])
+
+    def append(self, records):
+        """Thêm records vừa ghi vào MongoDB (gọi lúc ingest). Chưa tải thì bỏ qua, lần tải đầu sẽ đọc từ MongoDB."""
+        if not self.hours or not records:
+            return
+        # Dữ liệu cũ (sync bù, sau clear-sync-cache) nằm ngoài cửa sổ: không giữ trong RAM
+        cutoff = datetime.now() - timedelta(hours=self.hours)
+        records = [r for r in records if r["dt_obj"] >= cutoff]
+        if not records:
+            return
+        if self._loading is not None:
+            self._loading.extend(records)
+        elif self._loaded_at is not None:
+            self._add(records)
+
+    def _site_table(self, site, since):
+        """Table của một site từ mốc since, cắt bằng slice trên cột dt_obj đã sort."""
+        table = self._tables.get(site)
+        if table is None:
+            return None
+        if site in self._unsorted:
+            table = table.sort_by("dt_obj").combine_chunks()
+            self._unsorted.discard(site)
+        elif table["dt_obj"].num_chunks > 1:
+            table = table.combine_chunks()
+        # Bỏ phần đã ra khỏi cửa sổ
+        times = table["dt_obj"].chunk(0).to_numpy() if table.num_rows else np.array([], dtype="datetime64[us]")
+        cutoff = np.datetime64(datetime.now() - timedelta(hours=self.hours), "us")
+        table = table.slice(np.searchsorted(times, cutoff))
+        self._tables[site] = table
+        start = np.searchsorted(times, np.datetime64(since, "us")) - (len(times) - table.num_rows)
+        return table.slice(max(start, 0))
+
+    async def query(self, site_filter, device, hours):
+        """DataFrame giống filter_data, hoặc None nếu khoảng thời gian nằm ngoài cửa sổ cache.
+
+        site_filter giống AnalyzerEngine._records_query: tên site, {"$in": [...]} hoặc None (tất cả site).
+        """
+        if not self.covers(hours) or not await self._ensure_loaded():
+            return None
+
+        if site_filter is None:
+            sites = list(self._tables)
+        elif isinstance(site_filter, dict):
+            sites = site_filter["$in"]
+        else:
+            sites = [site_filter]
+
+        since = datetime.now() - timedelta(hours=hours)
+        tables = [t for t in (self._site_table(site, since) for site in sites) if t is not None and t.num_rows]
+        if not tables:
+            return pd.DataFrame()
+        table = pa.concat_tables(tables)
+        if device != "All Devices":
+            table = table.filter(pc.equal(table["device"], device))
+        if not table.num_rows:
+            return pd.DataFrame()
+        # Các cột chuỗi chuyển thẳng thành categorical, không qua Python str
+        return table.to_pandas(categories=["site", "device", "health", "state"])
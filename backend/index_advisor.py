@@ -0,0 +1,137 @@
+"""Chạy explain() cho các query của AnalyzerEngine và báo query nào quét cả collection (COLLSCAN)
+hoặc đọc quá nhiều document so với số kết quả.
+
+Chạy: python index_advisor.py  (hoặc GET /api/admin/index-report)
+"""
+import asyncio
+import os
+
+from database_mongo import reports_collection, device_latest_collection
+from engine import AnalyzerEngine, RECORD_FIELDS
+from retention import collection_for_window, rollups_for_window
+
+# Đọc quá số document này cho mỗi kết quả trả về thì coi là index chưa khớp
+ADVISOR_DOCS_RATIO = float(os.getenv("ADVISOR_DOCS_RATIO", 10))
+# Khoảng thời gian mẫu dùng cho các query có lọc theo giờ
+ADVISOR_SAMPLE_HOURS = int(os.getenv("ADVISOR_SAMPLE_HOURS", 24))
+
+
+def _winning_stages(node, out):
+    """Gom tên stage (và index) trong các winningPlan, bỏ qua rejectedPlans."""
+    if isinstance(node, list):
+        for item in node:
+            _winning_stages(item, out)
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            if key == "winningPlan":
+                _plan_stages(value, out)
+            elif key != "rejectedPlans":
+                _winning_stages(value, out)
+
+
+def _plan_stages(node, out):
+    if isinstance(node, list):
+        for item in node:
+            _plan_stages(item, out)
+    elif isinstance(node, dict):
+        if "stage" in node:
+            out.append(f"{node['stage']}({node['indexName']})" if node.get("indexName") else node["stage"])
+        for value in node.values():
+            _plan_stages(value, out)
+
+
+def _execution_stats(node, totals):
+    """Cộng executionStats của mọi stage đọc dữ liệu ($cursor của aggregate hoặc find/distinct)."""
+    if isinstance(node, list):
+        for item in node:
+            _execution_stats(item, totals)
+    elif isinstance(node, dict):
+        stats = node.get("executionStats")
+        if isinstance(stats, dict) and "totalDocsExamined" in stats:
+            totals["keys_examined"] += stats.get("totalKeysExamined", 0)
+            totals["docs_examined"] += stats.get("totalDocsExamined", 0)
+            totals["returned"] += stats.get("nReturned", 0)
+        for key, value in node.items():
+            if key != "executionStats":
+                _execution_stats(value, totals)
+
+
+def summarize_explain(name, collection, explain):
+    stages = []
+    _winning_stages(explain, stages)
+    totals = {"keys_examined": 0, "docs_examined": 0, "returned": 0}
+    _execution_stats(explain, totals)
+
+    ratio = totals["docs_examined"] / max(totals["returned"], 1)
+    warnings = []
+    if any(stage.startswith("COLLSCAN") for stage in stages):
+        warnings.append("COLLSCAN")
+    if "SORT" in stages:
+        warnings.append("sort trong bộ nhớ")
+    if ratio > ADVISOR_DOCS_RATIO:
+        warnings.append(f"đọc {ratio:.1f} document / kết quả")
+    return {
+        "query": name,
+        "collection": collection.name,
+        "stages": stages,
+        **totals,
+        "docs_per_result": round(ratio, 2),
+        "covered": totals["docs_examined"] == 0 and totals["keys_examined"] > 0,
+        "warnings": warnings,
+    }
+
+
+def _query_shapes(site, device, hours):
+    """(tên, collection, lệnh explain) cho từng query AnalyzerEngine gửi tới MongoDB, dựng bằng chính các hàm của engine."""
+    engine = AnalyzerEngine
+    records = collection_for_window(hours)
+    rollups = rollups_for_window(hours)
+
+    def find(collection, query, projection=RECORD_FIELDS):
+        return collection, {"find": collection.name, "filter": query, "projection": projection}
+
+    def aggregate(collection, pipeline):
+        return collection, {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}}
+
+    def distinct(collection, key, query):
+        return collection, {"distinct": collection.name, "key": key, "query": query}
+
+    return [
+        ("filter_data site + device", *find(records, engine._records_query(site, device, hours))),
+        ("filter_data site", *find(records, engine._records_query(site, "All Devices", hours))),
+        ("filter_data All Sites", *find(records, engine._records_query(None, "All Devices", hours))),
+        ("filter_data_multiple", *find(records, engine._records_query({"$in": [site]}, "All Devices", hours))),
+        ("distribution health", *aggregate(records, engine._distribution_pipeline([site], "All Devices", "health", hours))),
+        ("distribution health All Sites", *aggregate(records, engine._distribution_pipeline(None, "All Devices", "health", hours))),
+        ("clients series", *aggregate(rollups, engine._clients_series_pipeline([site], device, hours))),
+        ("clients series All Sites", *aggregate(rollups, engine._clients_series_pipeline(None, "All Devices", hours))),
+        ("get_sites", *distinct(reports_collection, "site", {})),
+        ("get_devices", *distinct(reports_collection, "device", {"site": site})),
+        ("get_site_device_map", *aggregate(device_latest_collection, engine._site_device_map_pipeline([site]))),
+        ("get_global_summary", *aggregate(device_latest_collection, engine._global_summary_pipeline([site]))),
+    ]
+
+
+async def index_report(hours=ADVISOR_SAMPLE_HOURS):
+    """Explain (executionStats) từng query với một site/device mẫu lấy từ device_latest."""
+    sample = await device_latest_collection.find_one({}, {"site": 1, "device": 1})
+    if not sample:
+        return []
+
+    report = []
+    for name, collection, command in _query_shapes(sample["site"], sample["device"], hours):
+        explain = await collection.database.command("explain", command, verbosity="executionStats")
+        report.append(summarize_explain(name, collection, explain))
+    return report
+
+
+async def main():
+    for row in await index_report():
+        flag = "!!" if row["warnings"] else "ok"
+        print(f"[{flag}] {row['query']:<32} {row['collection']:<15} docs {row['docs_examined']:>8} "
+              f"keys {row['keys_examined']:>8} returned {row['returned']:>8} | {' > '.join(row['stages'])}"
+              + (f" | {', '.join(row['warnings'])}" if row["warnings"] else ""))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,19 +1,35 @@
 import sys
 import os
-import boto3
 import asyncio
+import time
+import csv
+import io
+import json
+import copy
+import unicodedata
+from urllib.parse import quote
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Security
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, List
 import pandas as pd
 from datetime import datetime
 from dotenv import load_dotenv
+from pymongo import UpdateOne
 
 # Load environment variables
 load_dotenv()
 
 from engine import AnalyzerEngine
+from cache import TTLCache
+from events import DATA_CHANGED_MIN_INTERVAL_SECONDS, EventBroker
+from versions import SharedVersions
+from sync_coordinator import SYNC_HOT_WINDOW_HOURS, SyncCoordinator, schedule_files
+from filename_meta import parse_filename, snapshot_time, within_hours
+from r2_client import R2Client
+from retention import RETENTION_ENABLED, compact_records, retention_loop
+from index_advisor import index_report
 from database_mongo import init_mongo_indexes, users_collection, files_collection, settings_collection
 from auth import verify_password, get_password_hash, create_access_token, decode_token
 
@@ -27,21 +43,107 @@ sync_status = {
     "current_step": "Idle",
     "files_total": 0,
     "files_done": 0,
+    "files_parsed": 0,
+    "records_written": 0,
     "last_message": "Ready"
 }
 
+# Đẩy tiến độ sync và thông báo dữ liệu mới tới dashboard qua /api/events (SSE)
+events = EventBroker()
+# Cache và SSE nằm trong từng process; thay đổi ở process khác (worker / replica) được báo qua số phiên bản trong MongoDB
+versions = SharedVersions()
+
+def data_changed():
+    # Gọi sau mỗi lần ghi (mỗi file khi đang sync): event và phiên bản chung được gộp, tối đa một lần mỗi
+    # DATA_CHANGED_MIN_INTERVAL_SECONDS, để dashboard và cache của worker khác không bị làm mới liên tục
+    events.publish_data_changed()
+    versions.bump_soon("data_version", min_interval=DATA_CHANGED_MIN_INTERVAL_SECONDS)
+
+def data_changed_elsewhere():
+    """Process khác vừa ghi / xoá dữ liệu: bỏ cache kết quả và hot window của process này, báo dashboard tải lại."""
+    backend.cache.invalidate()
+    backend.hot.invalidate()
+    events.publish_data_changed()
+
+backend.on_data_changed = data_changed
+versions.on("data_version", data_changed_elsewhere)
+
+def update_sync_status(**changes):
+    """Cập nhật sync_status và gửi event "sync" (kèm "sync_done" khi sync vừa kết thúc)."""
+    was_syncing = sync_status["is_syncing"]
+    sync_status.update(changes)
+    events.publish("sync", dict(sync_status))
+    if was_syncing and not sync_status["is_syncing"]:
+        events.publish("sync_done", {"last_message": sync_status["last_message"]})
+
+# Nhiều worker / replica cùng sync: lease, chia file và tiến độ chung nằm trong MongoDB.
+# sync_status là trạng thái của process này, được cập nhật từ tiến độ chung khi đang tham gia sync.
+coordinator = SyncCoordinator()
+coordinator.on_status = lambda shared: update_sync_status(**shared)
+_sync_lock = asyncio.Lock()
+
+async def shared_sync_status():
+    """Tiến độ sync chung của mọi worker (process này có thể không tham gia lượt sync đang chạy)."""
+    return {**sync_status, **await coordinator.status()}
+
+async def close_sync(message, run_id=None):
+    """Kết thúc lượt sync, báo các process khác và cập nhật sync_status của process này (gửi sync_done)."""
+    await coordinator.close(message, run_id)
+    await versions.bump("sync_version")
+    update_sync_status(**await coordinator.status())
+
+async def sync_changed_elsewhere():
+    """Process khác vừa mở / kết thúc lượt sync: lấy tiến độ chung để client của process này cũng thấy."""
+    was_syncing = sync_status["is_syncing"]
+    update_sync_status(**await coordinator.status())
+    if not was_syncing and not sync_status["is_syncing"]:
+        events.publish("sync_done", {"last_message": sync_status["last_message"]})
+
+versions.on("sync_version", sync_changed_elsewhere)
+
 # --- Auth Dependencies ---
-async def get_current_user(auth: HTTPAuthorizationCredentials = Security(security)):
-    payload = decode_token(auth.credentials)
-    if not payload:
+# Cache token đã giải mã và user document để mỗi request không phải decode JWT + find_one.
+# User bị sửa/xoá/lưu dashboard thì entry bị xoá ngay (forget_user); process khác xoá cache khi thấy user_version đổi.
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", 30))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", 1024))
+token_cache = TTLCache(ttl=AUTH_CACHE_TTL_SECONDS, max_entries=AUTH_CACHE_MAX_ENTRIES)
+user_cache = TTLCache(ttl=AUTH_CACHE_TTL_SECONDS, max_entries=AUTH_CACHE_MAX_ENTRIES)
+
+async def load_token(token):
+    return decode_token(token)
+
+async def load_user(username):
+    user = await users_collection.find_one({"username": username})
+    if user:
+        user["_id"] = str(user["_id"])
+    return user
+
+async def forget_user(username):
+    user_cache.discard(username)
+    await versions.bump("user_version")
+
+def users_changed_elsewhere():
+    token_cache.invalidate()
+    user_cache.invalidate()
+
+versions.on("user_version", users_changed_elsewhere)
+
+async def resolve_user(token):
+    payload = await token_cache.get_or_load(token, lambda: load_token(token))
+    # Token hết hạn trong lúc còn nằm trong cache
+    if not payload or payload.get("exp", 0) < time.time():
         raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = await users_collection.find_one({"username": payload.get("sub")})
+
+    username = payload.get("sub")
+    user = await user_cache.get_or_load(username, lambda: load_user(username))
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
-    
-    user["_id"] = str(user["_id"])
-    return user
+
+    # Bản sao sâu: request sửa cả dict lồng nhau (widget trong dashboard) cũng không đụng tới object dùng chung trong cache
+    return copy.deepcopy(user)
+
+async def get_current_user(auth: HTTPAuthorizationCredentials = Security(security)):
+    return await resolve_user(auth.credentials)
 
 def admin_only(user: dict = Depends(get_current_user)):
     if user.get("role") != "admin":
@@ -73,6 +175,17 @@ class FilterRequest(BaseModel):
     metric: Optional[str] = "clients"
     chart_type: Optional[str] = "area"
     hours: Optional[int] = None
+    # Giới hạn số điểm của biểu đồ clients (LTTB) và/hoặc gom theo khoảng cố định (phút)
+    max_points: Optional[int] = Field(None, ge=3)
+    bucket_minutes: Optional[int] = Field(None, ge=1)
+    # "ndjson": trả về dạng stream, dòng đầu {"summary": ...} rồi mỗi dòng một điểm dữ liệu
+    format: Optional[str] = "json"
+
+class BatchWidget(FilterRequest):
+    id: Optional[str] = None
+
+class BatchAnalyzeRequest(BaseModel):
+    widgets: List[BatchWidget]
 
 # --- Startup ---
 @app.on_event("startup")
@@ -92,6 +205,31 @@ async def startup_event():
     count = await backend.get_total_records_count()
     print(f"Startup: MongoDB connected with {count} records.")
 
+    # Theo dõi thay đổi từ các worker / replica khác (lần poll đầu chỉ ghi nhận mốc)
+    await versions.poll()
+    asyncio.create_task(versions.watch())
+
+    # Dữ liệu cũ (trước khi có các bảng tổng hợp) -> tổng hợp lại trong background
+    if await backend.derived_missing():
+        print("Startup: Rebuilding rollups in background...")
+        asyncio.create_task(backend.rebuild_derived())
+
+    # Rút gọn records cũ theo các tầng 15 phút / 1 giờ và xoá dữ liệu quá hạn
+    if RETENTION_ENABLED:
+        asyncio.create_task(retention_loop(on_change=backend.notify_data_changed))
+
+    # In các query đang COLLSCAN / đọc quá nhiều document (explain), bật khi cần kiểm tra index
+    if os.getenv("INDEX_REPORT_ON_STARTUP", "0").lower() in ("1", "true", "yes"):
+        for row in await index_report():
+            if row["warnings"]:
+                print(f"Index report: {row['query']} on {row['collection']}: {', '.join(row['warnings'])} ({' > '.join(row['stages'])})")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    backend.shutdown()
+    if _r2_client is not None:
+        await _r2_client.close()
+
 # --- R2 Helpers ---
 R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
 R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
@@ -99,68 +237,210 @@ R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
 DATA_FOLDER_PREFIX = os.getenv("DATA_FOLDER_PREFIX", "")
 
-def get_r2_client():
-    if not all([R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]): return None
-    return boto3.client("s3", 
-        endpoint_url=f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com",
-        aws_access_key_id=R2_ACCESS_KEY_ID,
-        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        region_name="auto"
-    )
-
-async def fetch_r2_files():
-    global sync_status
-    client = get_r2_client()
-    if not client: 
-        sync_status["last_message"] = "Invalid R2 Credentials"
-        return []
-    
-    sync_status["is_syncing"] = True
-    sync_status["current_step"] = "Scanning Cloudflare R2..."
-    sync_status["files_done"] = 0
-    
-    # 1. Lấy danh sách file đã xử lý từ DB
-    processed = await files_collection.distinct("filename")
-    processed_set = set(processed)
-    
-    # 2. Liệt kê file trên R2
-    paginator = client.get_paginator('list_objects_v2')
-    pages = await asyncio.to_thread(lambda: list(paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix=DATA_FOLDER_PREFIX)))
-    
-    to_download = []
-    for page in pages:
-        for obj in page.get('Contents', []):
-            key = obj['Key']
-            fname = os.path.basename(key)
-            if key.endswith('/') or not (key.lower().endswith('.csv') or key.lower().endswith('.xlsx')): continue
-            if fname in processed_set: continue
-            to_download.append(key)
-    
-    if not to_download:
-        sync_status["is_syncing"] = False
-        sync_status["current_step"] = "Idle"
-        sync_status["last_message"] = "Everything is up to date"
-        return []
+# Cho phép trỏ tới endpoint S3 khác (MinIO, moto) khi chạy thử local
+R2_ENDPOINT_URL = os.getenv("R2_ENDPOINT_URL") or (f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com" if R2_ACCOUNT_ID else None)
 
-    sync_status["files_total"] = len(to_download)
-    sync_status["current_step"] = f"Downloading {len(to_download)} new files..."
+_r2_client = None
 
-    # 3. Tải các file mới song song (giới hạn 50 file cùng lúc để tránh quá tải mạng)
-    semaphore = asyncio.Semaphore(50)
-    
-    async def download_one_safe(key):
-        async with semaphore:
+def get_r2_client():
+    """Client R2 dùng chung (giữ pool kết nối giữa các lần sync)."""
+    global _r2_client
+    if not all([R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]): return None
+    if _r2_client is None:
+        _r2_client = R2Client(R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME)
+    return _r2_client
+
+# Số file tải song song từ R2. Cũng là số file tối đa đã tải xong đang chờ parse (giới hạn RAM khi sync)
+R2_DOWNLOAD_CONCURRENCY = int(os.getenv("R2_DOWNLOAD_CONCURRENCY", 16))
+
+# "full": liệt kê toàn bộ bucket mỗi lần sync.
+# "incremental": chỉ liệt kê các key sau key lớn nhất đã thấy (StartAfter), phù hợp khi tên file mới luôn
+# đứng sau tên file cũ. Cứ mỗi R2_FULL_SCAN_INTERVAL giây vẫn quét toàn bộ một lần để bắt các file có key
+# nhỏ hơn con trỏ hoặc bị ghi đè (phát hiện qua ETag/Size).
+R2_SYNC_MODE = os.getenv("R2_SYNC_MODE", "full")
+R2_FULL_SCAN_INTERVAL = int(os.getenv("R2_FULL_SCAN_INTERVAL", 3600))
+# Chỉ tải các file có thời điểm snapshot (lấy từ tên file lúc liệt kê) trong số giờ gần nhất này (0 = không giới hạn)
+R2_SYNC_MAX_AGE_HOURS = float(os.getenv("R2_SYNC_MAX_AGE_HOURS", 0))
+
+async def list_new_r2_files(client):
+    """Liệt kê các file .csv/.xlsx trên R2 chưa được xử lý hoặc đã thay đổi.
+
+    Site / thời điểm snapshot được đọc từ tên file ngay lúc liệt kê (không cần tải): file không có ngày giờ
+    hoặc cũ hơn R2_SYNC_MAX_AGE_HOURS bị bỏ qua. Trả về (keys cần tải, {filename: metadata của object},
+    cập nhật con trỏ để lưu sau khi sync xong).
+    """
+    cursor = await settings_collection.find_one({"type": "r2_cursor"}) or {}
+    now = datetime.utcnow()
+    last_full_scan = cursor.get("last_full_scan")
+    full_scan = (R2_SYNC_MODE != "incremental" or not cursor.get("start_after") or not last_full_scan
+                 or (now - last_full_scan).total_seconds() >= R2_FULL_SCAN_INTERVAL)
+
+    # 1. Liệt kê file trên R2 (chế độ incremental: chỉ các key sau con trỏ)
+    start_after = None if full_scan else cursor["start_after"]
+    objects = {}
+    undated, too_old = [], 0
+    max_key = cursor.get("start_after") or ""
+    async for obj in client.list_objects(DATA_FOLDER_PREFIX, start_after=start_after):
+        key = obj['Key']
+        max_key = max(max_key, key)
+        if key.endswith('/') or not (key.lower().endswith('.csv') or key.lower().endswith('.xlsx')): continue
+        meta = parse_filename(key)
+        dt_obj = snapshot_time(meta)
+        if dt_obj is None:
+            undated.append(key)
+            continue
+        if not within_hours(dt_obj, R2_SYNC_MAX_AGE_HOURS):
+            too_old += 1
+            continue
+        objects[os.path.basename(key)] = {"key": key, "etag": obj.get("ETag"), "size": obj.get("Size"),
+                                          "site": meta.site, "dt_obj": meta.dt_obj, "last_modified": obj.get("LastModified")}
+    if undated:
+        print(f"R2: skipped {len(undated)} files without a date/time in the name (e.g. {undated[0]})")
+    if too_old:
+        print(f"R2: skipped {too_old} files older than {R2_SYNC_MAX_AGE_HOURS}h")
+
+    # 2. Chỉ tra các file vừa liệt kê trong DB, không tải toàn bộ danh sách file đã xử lý
+    processed = {}
+    if objects:
+        found = files_collection.find({"filename": {"$in": list(objects)}}, {"filename": 1, "etag": 1, "size": 1})
+        processed = {f["filename"]: f async for f in found}
+
+    to_download, changed, baseline = [], [], []
+    for fname, meta in objects.items():
+        old = processed.get(fname)
+        if old is None:
+            to_download.append(meta["key"])
+        elif not old.get("etag"):
+            # Xử lý từ trước khi lưu ETag: ghi nhận ETag/Size hiện tại (không tải lại) để lần sau nhận ra file bị ghi đè
+            baseline.append(UpdateOne({"filename": fname, "etag": {"$exists": False}},
+                                      {"$set": {"etag": meta["etag"], "size": meta["size"]}}))
+        elif old["etag"] != meta["etag"] or old.get("size") != meta["size"]:
+            # File bị ghi đè trên R2 -> xử lý lại
+            changed.append(fname)
+            to_download.append(meta["key"])
+    if baseline:
+        await files_collection.bulk_write(baseline, ordered=False)
+    if changed:
+        await files_collection.delete_many({"filename": {"$in": changed}})
+
+    cursor_update = {"start_after": max_key}
+    if full_scan:
+        cursor_update["last_full_scan"] = now
+    return to_download, objects, cursor_update
+
+async def save_r2_sync_state(objects, cursor_update):
+    """Lưu ETag/Size của các file đã xử lý xong và con trỏ StartAfter cho lần sync sau."""
+    ops = [
+        UpdateOne({"filename": fname}, {"$set": {"etag": meta["etag"], "size": meta["size"]}})
+        for fname, meta in objects.items()
+    ]
+    if ops:
+        # Không upsert: file lỗi/không có dữ liệu chưa được đánh dấu thì vẫn được thử lại lần sau
+        await files_collection.bulk_write(ops, ordered=False)
+    await settings_collection.update_one({"type": "r2_cursor"}, {"$set": cursor_update}, upsert=True)
+
+async def fetch_r2_files(client, next_key, on_downloaded=None):
+    """Tải song song các file và trả về từng (bytes, filename) ngay khi tải xong.
+
+    next_key(): coroutine trả về key tiếp theo cần tải (None khi hết), vd. SyncCoordinator.claim.
+    Hàng đợi giới hạn R2_DOWNLOAD_CONCURRENCY phần tử: khi bước parse/ghi DB chậm hơn,
+    các worker tải sẽ tự dừng chờ (backpressure) thay vì giữ cả bucket trong RAM.
+    """
+    queue = asyncio.Queue(maxsize=R2_DOWNLOAD_CONCURRENCY)
+
+    async def download_worker():
+        while (key := await next_key()) is not None:
             try:
-                resp = await asyncio.to_thread(client.get_object, Bucket=R2_BUCKET_NAME, Key=key)
-                data = (resp['Body'].read(), os.path.basename(key))
-                sync_status["files_done"] += 1
-                return data
+                body = await client.get_object_bytes(key)
             except Exception as e:
                 print(f"Failed to download {key}: {e}")
+                continue
+            await queue.put((body, os.path.basename(key)))
+            if on_downloaded:
+                on_downloaded()
+
+    async def close_when_done(workers):
+        await asyncio.gather(*workers, return_exceptions=True)
+        await queue.put(None)
+
+    workers = [asyncio.create_task(download_worker()) for _ in range(R2_DOWNLOAD_CONCURRENCY)]
+    closer = asyncio.create_task(close_when_done(workers))
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+    finally:
+        closer.cancel()
+        for w in workers: w.cancel()
+
+# sync_r2_files không tham gia (process này đang sync, hoặc worker khác đang quét R2): không được đụng tới sync_status
+SYNC_NOT_PARTICIPATING = "not participating"
+
+async def sync_r2_files():
+    """Tham gia lượt sync đang chạy của worker khác, hoặc (nếu giữ được lease) quét R2 và mở lượt mới.
+
+    Sau đó nhận từng file qua coordinator rồi stream tải -> parse -> ghi MongoDB; worker xử lý xong cuối cùng
+    lưu ETag / con trỏ R2. Trả về (new_count, skipped) của worker này, None nếu không có gì để đồng bộ
+    (sync_status đã được cập nhật) hoặc SYNC_NOT_PARTICIPATING.
+    """
+    client = get_r2_client()
+    if not client: 
+        update_sync_status(last_message="Invalid R2 Credentials")
+        return None
+    if _sync_lock.locked():
+        # Process này đang tham gia sync rồi (auto-sync và /api/load cùng gọi)
+        return SYNC_NOT_PARTICIPATING
+
+    async with _sync_lock:
+        run_id = await coordinator.active_run()
+        if run_id is None:
+            if not await coordinator.acquire_lease():
+                # Worker khác đang quét R2, lượt sync của nó sẽ được tham gia ở lần gọi sau
+                return SYNC_NOT_PARTICIPATING
+            update_sync_status(is_syncing=True, current_step="Scanning Cloudflare R2...",
+                               files_done=0, files_total=0, files_parsed=0, records_written=0)
+            try:
+                async with coordinator.working():
+                    to_download, objects, cursor_update = await list_new_r2_files(client)
+            except Exception as e:
+                await close_sync(f"Error: {str(e)}")
+                raise
+            if not to_download:
+                await save_r2_sync_state({}, cursor_update)
+                await close_sync("Everything is up to date")
                 return None
-
-    results = await asyncio.gather(*[download_one_safe(k) for k in to_download]) 
-    return [r for r in results if r is not None]
+            by_key = {m["key"]: {"filename": f, **m} for f, m in objects.items()}
+            # Mới nhất trước thay vì theo thứ tự key (xem schedule_files)
+            run_id = await coordinator.open_run(schedule_files([by_key[k] for k in to_download]), cursor_update)
+            if run_id is None:
+                # Mất lease trong lúc quét: worker khác đã mở lượt sync
+                return SYNC_NOT_PARTICIPATING
+            await versions.bump("sync_version")
+
+        update_sync_status(is_syncing=True, current_step="Joining sync...")
+        # 3. Mỗi file được parse và ghi vào DB ngay khi tải xong.
+        # Các file trong hot window được ghi hết (flush) trước rồi mới nạp dữ liệu cũ hơn.
+        new_count, skipped = 0, []
+        async with coordinator.working(run_id):
+            progress = coordinator.progress
+            for hot in ([True, False] if SYNC_HOT_WINDOW_HOURS else [None]):
+                base = dict(progress)
+                added, skipped_files = await backend.load_multiple_from_memory(
+                    fetch_r2_files(client, lambda: coordinator.claim(run_id, hot=hot),
+                                   on_downloaded=lambda: progress.update(files_done=progress["files_done"] + 1)),
+                    on_progress=lambda parsed, written: progress.update(
+                        files_parsed=base["files_parsed"] + parsed, records_written=base["records_written"] + written),
+                )
+                await coordinator.complete(run_id)
+                new_count += added
+                skipped += skipped_files
+
+        finished = await coordinator.try_finish(run_id)
+        if finished:
+            cursor_update, files = finished
+            await save_r2_sync_state({f["filename"]: f for f in files}, cursor_update)
+            shared = await coordinator.status()
+            await close_sync(f"Success! Added {shared.get('records_written', 0)} records.", run_id)
+        return new_count, skipped
 
 # --- CORS ---
 from fastapi.middleware.cors import CORSMiddleware
@@ -208,12 +488,14 @@ async def create_user(req: UserCreate, admin: dict = Depends(admin_only)):
     new_user = req.dict()
     new_user["password"] = get_password_hash(req.password)
     await users_collection.insert_one(new_user)
+    await forget_user(req.username)
     return {"status": "success"}
 
 @app.delete("/api/admin/users/{username}")
 async def delete_user(username: str, admin: dict = Depends(admin_only)):
     if username == admin["username"]: raise HTTPException(status_code=400, detail="Self-delete failed")
     await users_collection.delete_one({"username": username})
+    await forget_user(username)
     return {"status": "success"}
 
 @app.put("/api/admin/users/{username}")
@@ -226,17 +508,18 @@ async def update_user(username: str, req: UserUpdate, admin: dict = Depends(admi
     if not update_data: return {"status": "no change"}
     
     await users_collection.update_one({"username": username}, {"$set": update_data})
+    await forget_user(username)
     return {"status": "success"}
 
 @app.post("/api/user/dashboard")
 async def save_dashboard(req: DashboardConfig, user: dict = Depends(get_current_user)):
     await users_collection.update_one({"username": user["username"]}, {"$set": {"dashboard": req.config}})
+    await forget_user(user["username"])
     return {"status": "success"}
 
 @app.post("/api/load")
 async def load_data(background_tasks: BackgroundTasks, user: dict = Depends(get_current_user)):
-    global sync_status
-    if user["role"] == "admin" and sync_status["is_syncing"]:
+    if user["role"] == "admin" and (await shared_sync_status())["is_syncing"]:
         # Trả về luôn nếu admin đang có sync chạy rồi
         return {
             "status": "warning",
@@ -259,8 +542,9 @@ async def load_data(background_tasks: BackgroundTasks, user: dict = Depends(get_
     if show_all:
         site_map["All Sites"] = ["All Devices"]
         
+    device_map = await backend.get_site_device_map(sites)
     for s in sites:
-        site_map[s] = ["All Devices"] + await backend.get_devices(site=s)
+        site_map[s] = ["All Devices"] + device_map.get(s, [])
 
     # Xác định Site mặc định cho Dashboard nếu user chưa có cấu hình
     default_site = "All Sites" if show_all else (sites[0] if sites else "Unknown")
@@ -276,9 +560,7 @@ async def load_data(background_tasks: BackgroundTasks, user: dict = Depends(get_
             sanitized_dashboard.append(widget)
         else:
             # Nếu widget bị sai site, tự động chuyển về site mặc định thay vì xóa bỏ
-            widget["site"] = default_site
-            widget["device"] = "All Devices"
-            sanitized_dashboard.append(widget)
+            sanitized_dashboard.append({**widget, "site": default_site, "device": "All Devices"})
 
     if not sanitized_dashboard:
         sanitized_dashboard = [
@@ -287,21 +569,14 @@ async def load_data(background_tasks: BackgroundTasks, user: dict = Depends(get_
 
     # 2. Chạy sync R2 trong background
     async def run_sync():
-        global sync_status
         try:
-            files = await fetch_r2_files()
-            if files:
-                sync_status["current_step"] = "Saving to Database..."
-                new_count, skipped = await backend.load_multiple_from_memory(files)
-                sync_status["last_message"] = f"Success! Added {new_count} records."
-            else:
-                if sync_status["last_message"] != "Invalid R2 Credentials":
-                    sync_status["last_message"] = "No new data found on R2."
+            result = await sync_r2_files()
         except Exception as e:
-            sync_status["last_message"] = f"Error: {str(e)}"
-        finally:
-            sync_status["is_syncing"] = False
-            sync_status["current_step"] = "Idle"
+            update_sync_status(is_syncing=False, current_step="Idle", last_message=f"Error: {str(e)}")
+            return
+        if isinstance(result, tuple):
+            # Worker khác có thể vẫn đang xử lý file của lượt sync: lấy tiến độ chung thay vì báo Idle
+            update_sync_status(**await coordinator.status())
 
     background_tasks.add_task(run_sync)
     
@@ -324,18 +599,56 @@ async def inject_test_data(admin: dict = Depends(admin_only)):
 
 @app.get("/api/sync-status")
 async def get_sync_status(user: dict = Depends(get_current_user)):
-    return sync_status
+    return await shared_sync_status()
+
+@app.get("/api/events")
+async def event_stream(token: str):
+    """Server-Sent Events: "sync" (tiến độ), "sync_done" và "data_changed" (có dữ liệu mới -> tải lại biểu đồ).
+
+    EventSource của trình duyệt không gửi được header nên token truyền qua query string.
+    """
+    await resolve_user(token)
+    return StreamingResponse(
+        events.stream(initial=[("sync", await shared_sync_status())]),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def allowed_sites_for(user):
+    return user.get("allowed_sites", []) if user["role"] == "user" else await backend.get_sites()
+
+def widget_sites(site, user, allowed):
+    """Danh sách site của một biểu đồ (None = tất cả site), 403 nếu user không được xem site đó."""
+    if site != "All Sites" and site not in allowed:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if site != "All Sites":
+        return [site]
+    return allowed if user["role"] == "user" else None
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def ndjson_line(obj):
+    return json.dumps(obj, default=_json_default, ensure_ascii=False) + "\n"
+
+async def ndjson_stream(header, batches):
+    """Dòng header rồi mỗi batch (đọc dần từ cursor) thành một chunk NDJSON."""
+    yield ndjson_line(header)
+    async for batch in batches:
+        yield "".join(ndjson_line(r) for r in batch)
+
+def content_disposition(filename):
+    """Header tải file: tên ASCII cho client cũ và filename* (RFC 5987) giữ nguyên tên site tiếng Việt."""
+    fallback = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+    fallback = fallback.replace('"', "").replace("\\", "") or "export"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
 
 @app.post("/api/analyze")
 async def analyze(req: FilterRequest, user: dict = Depends(get_current_user)):
-    allowed = user.get("allowed_sites", []) if user["role"] == "user" else await backend.get_sites()
-    if req.site != "All Sites" and req.site not in allowed:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    if req.site == "All Sites":
-        df = await backend.filter_data_multiple(allowed, req.device, req.hours) if user["role"] == "user" else await backend.filter_data(req.site, req.device, req.hours)
-    else:
-        df = await backend.filter_data(req.site, req.device, req.hours)
+    allowed = await allowed_sites_for(user)
+    sites = widget_sites(req.site, user, allowed)
 
     summary = None
     if req.metric == "clients":
@@ -344,35 +657,111 @@ async def analyze(req: FilterRequest, user: dict = Depends(get_current_user)):
         asl = [req.site] if req.site != "All Sites" else allowed
         summary = await backend.get_global_summary(allowed_sites=asl)
 
-    if df.empty: return {"data": [], "summary": summary}
-
-    # Dọn dẹp dữ liệu: Xóa khoảng trắng thừa để tránh trùng lặp do lỗi nhập liệu
-    df['site'] = df['site'].astype(str).str.strip()
-    df['device'] = df['device'].astype(str).str.strip()
-    df['time_str'] = df['dt_obj'].dt.strftime("%Y-%m-%d %H:%M")
+    if req.format == "ndjson":
+        # Không dựng cả list kết quả: đọc cursor aggregation trong lúc gửi
+        batches = backend.iter_metric(
+            sites, req.device, req.metric, req.hours, max_points=req.max_points, bucket_minutes=req.bucket_minutes
+        )
+        return StreamingResponse(ndjson_stream({"summary": summary}, batches), media_type="application/x-ndjson")
 
-    result_data = []
-    if req.metric == "clients":
-        # 1. Lọc trùng: Lấy MAX nếu cùng Site, Device, Phút
-        df_dedup = df.groupby(['site', 'device', 'time_str'])['clients'].max().reset_index()
-        
-        # 2. Nhóm theo thời gian: Cộng tổng clients của tất cả thiết bị trong phút đó
-        chart_data = df_dedup.groupby('time_str')['clients'].sum().sort_index()
-        result_data = [{"time": t, "clients": int(c)} for t, c in chart_data.items()]
-    
-    elif req.metric in ["health", "state"]:
-        # Tương tự cho Health/State: Lấy bản ghi mới nhất/duy nhất của mỗi thiết bị trong phút đó
-        df_dedup = df.sort_values('dt_obj').drop_duplicates(['site', 'device', 'time_str'], keep='last')
-        dist = df_dedup[req.metric].value_counts()
-        result_data = [{"name": str(label), "value": int(val)} for label, val in dist.items()]
-    
+    result_data = await backend.analyze_metric(
+        sites, req.device, req.metric, req.hours, max_points=req.max_points, bucket_minutes=req.bucket_minutes
+    )
     return {"data": result_data, "summary": summary}
 
+EXPORT_FIELDS = ["dt_obj", "site", "device", "clients", "health", "state", "model", "ip"]
+
+async def export_stream(batches, fmt):
+    """Ghi từng batch records thành một chunk CSV / NDJSON, bộ nhớ chỉ giữ một batch."""
+    if fmt == "csv":
+        yield ",".join(EXPORT_FIELDS) + "\n"
+    async for batch in batches:
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for r in batch:
+                row = [r.get(f, "") for f in EXPORT_FIELDS]
+                if isinstance(row[0], datetime):
+                    row[0] = row[0].strftime("%Y-%m-%d %H:%M:%S")
+                writer.writerow(row)
+            yield buf.getvalue()
+        else:
+            yield "".join(ndjson_line({f: r.get(f) for f in EXPORT_FIELDS}) for r in batch)
+
+@app.get("/api/export/records")
+async def export_records(site: str = "All Sites", device: str = "All Devices", hours: Optional[int] = None,
+                         format: str = "csv", user: dict = Depends(get_current_user)):
+    """Xuất records thô (không giới hạn số dòng) dạng CSV hoặc NDJSON, đọc cursor và gửi dần từng batch."""
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format phải là csv hoặc ndjson")
+    allowed = await allowed_sites_for(user)
+    sites = widget_sites(site, user, allowed)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"{site.replace(' ', '_')}_records_{datetime.now().strftime('%Y%m%d_%H%M')}.{format}"
+    return StreamingResponse(
+        export_stream(backend.iter_records(sites, device, hours), format),
+        media_type=media_type,
+        headers={"Content-Disposition": content_disposition(filename)},
+    )
+
+@app.post("/api/analyze/batch")
+async def analyze_batch(req: BatchAnalyzeRequest, user: dict = Depends(get_current_user)):
+    """Tính tất cả widget của dashboard trong một request (xác thực và lấy danh sách site một lần,
+    các widget trùng / chồng lấn dữ liệu dùng chung lần đọc). Kết quả theo đúng thứ tự widgets."""
+    allowed = await allowed_sites_for(user)
+
+    results = [None] * len(req.widgets)
+    queries, positions = [], []
+    for i, w in enumerate(req.widgets):
+        try:
+            sites = widget_sites(w.site, user, allowed)
+        except HTTPException as e:
+            results[i] = {"id": w.id, "error": e.detail}
+            continue
+        queries.append({
+            "sites": sites, "device": w.device, "metric": w.metric, "hours": w.hours,
+            "max_points": w.max_points, "bucket_minutes": w.bucket_minutes,
+        })
+        positions.append(i)
+
+    data = await backend.analyze_batch(queries)
+    for i, result_data in zip(positions, data):
+        w = req.widgets[i]
+        summary = None
+        if w.metric == "clients":
+            # Giống /api/analyze; get_global_summary được cache nên các widget cùng site không tính lại
+            summary = await backend.get_global_summary(allowed_sites=[w.site] if w.site != "All Sites" else allowed)
+        results[i] = {"id": w.id, "data": result_data, "summary": summary}
+    return {"results": results}
+
 @app.post("/api/admin/clear-sync-cache", dependencies=[Depends(admin_only)])
 async def clear_sync_cache():
     await files_collection.delete_many({})
+    await settings_collection.delete_one({"type": "r2_cursor"})
     return {"message": "Đã reset bộ nhớ đệm đồng bộ. Hệ thống sẽ quét lại toàn bộ file từ Cloud."}
 
+@app.post("/api/admin/rebuild-rollups", dependencies=[Depends(admin_only)])
+async def rebuild_rollups(background_tasks: BackgroundTasks):
+    background_tasks.add_task(backend.rebuild_derived)
+    return {"message": "Đang tổng hợp lại dữ liệu biểu đồ và thống kê trong nền."}
+
+@app.post("/api/admin/compact", dependencies=[Depends(admin_only)])
+async def compact_now():
+    if not RETENTION_ENABLED:
+        raise HTTPException(status_code=400, detail="Retention chưa được bật (RETENTION_ENABLED).")
+    deleted = await compact_records()
+    backend.notify_data_changed()
+    return {"message": "Đã rút gọn dữ liệu.", "deleted": deleted}
+
+@app.get("/api/admin/index-report", dependencies=[Depends(admin_only)])
+async def get_index_report(hours: int = 24):
+    return await index_report(hours)
+
+@app.get("/api/admin/cache-stats", dependencies=[Depends(admin_only)])
+async def cache_stats():
+    return backend.cache.stats()
+
 @app.post("/api/admin/clear-test-data", dependencies=[Depends(admin_only)])
 async def clear_test_data():
     count = await backend.clear_test_data()
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import random
+from contextlib import AsyncExitStack
+
+import aiohttp
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Số kết nối HTTP giữ sẵn tới R2 (nên >= R2_DOWNLOAD_CONCURRENCY)
+R2_MAX_POOL_CONNECTIONS = int(os.getenv("R2_MAX_POOL_CONNECTIONS", 32))
+# Số lần thử lại khi tải một object bị lỗi mạng / 5xx / throttling (botocore), và khi đứt kết nối giữa lúc đọc body
+R2_MAX_RETRIES = int(os.getenv("R2_MAX_RETRIES", 4))
+R2_RETRY_BASE_DELAY = float(os.getenv("R2_RETRY_BASE_DELAY", 0.5))
+# Kích thước mỗi lần đọc body (đọc dạng stream, không đọc cả file một lần)
+R2_READ_CHUNK_SIZE = int(os.getenv("R2_READ_CHUNK_SIZE", 1024 * 1024))
+
+
+class R2Client:
+    """Client S3 async (aiobotocore) dùng chung cho mọi lần sync, giữ pool kết nối tới R2.
+
+    endpoint_url có thể trỏ tới MinIO/moto để chạy thử local.
+    """
+
+    def __init__(self, endpoint_url, access_key, secret_key, bucket):
+        self.endpoint_url = endpoint_url
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.bucket = bucket
+        self._client = None
+        self._stack = None
+        self._lock = asyncio.Lock()
+
+    async def _get_client(self):
+        async with self._lock:
+            if self._client is None:
+                self._stack = AsyncExitStack()
+                self._client = await self._stack.enter_async_context(get_session().create_client(
+                    "s3",
+                    endpoint_url=self.endpoint_url,
+                    aws_access_key_id=self.access_key,
+                    aws_secret_access_key=self.secret_key,
+                    region_name="auto",
+                    config=AioConfig(
+                        max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+                        # botocore tự retry lỗi ở mức request (kết nối, 5xx, throttling) với backoff
+                        retries={"max_attempts": R2_MAX_RETRIES + 1, "mode": "standard"},
+                    ),
+                ))
+            return self._client
+
+    async def close(self):
+        async with self._lock:
+            if self._stack is not None:
+                await self._stack.aclose()
+            self._client = None
+            self._stack = None
+
+    async def list_objects(self, prefix="", start_after=None):
+        """Duyệt các object dưới prefix (theo thứ tự key), tuỳ chọn chỉ lấy key sau start_after."""
+        client = await self._get_client()
+        params = {"Bucket": self.bucket, "Prefix": prefix}
+        if start_after:
+            params["StartAfter"] = start_after
+        async for page in client.get_paginator("list_objects_v2").paginate(**params):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    async def get_object_bytes(self, key):
+        """Tải nội dung một object, đọc body theo từng chunk.
+
+        Nếu kết nối đứt giữa chừng thì thử lại với backoff và đọc tiếp bằng Range từ byte đã nhận
+        (kèm IfMatch theo ETag để không ghép nhầm nếu object vừa bị ghi đè).
+        """
+        client = await self._get_client()
+        buf = bytearray()
+        etag = None
+        for attempt in range(R2_MAX_RETRIES + 1):
+            params = {"Bucket": self.bucket, "Key": key}
+            if buf:
+                params["Range"] = f"bytes={len(buf)}-"
+                params["IfMatch"] = etag
+            try:
+                resp = await client.get_object(**params)
+            except ClientError as e:
+                # Lỗi kết nối / 5xx / 429 trước khi có response đã được botocore thử lại (retries trong AioConfig)
+                if buf and e.response.get("Error", {}).get("Code") == "PreconditionFailed" and attempt < R2_MAX_RETRIES:
+                    # Object đổi giữa hai lần đọc -> tải lại từ đầu
+                    buf.clear()
+                    continue
+                raise
+            etag = resp.get("ETag")
+            try:
+                async with resp["Body"] as stream:
+                    async for chunk in stream.iter_chunks(R2_READ_CHUNK_SIZE):
+                        buf.extend(chunk)
+                return bytes(buf)
+            except (BotoCoreError, aiohttp.ClientError, OSError, asyncio.TimeoutError):
+                # Đứt kết nối giữa lúc đọc body: botocore không thử lại phần này
+                if attempt == R2_MAX_RETRIES:
+                    raise
+            await asyncio.sleep(R2_RETRY_BASE_DELAY * (2 ** attempt) * (0.5 + random.random()))
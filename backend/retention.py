@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from database_mongo import (
+    reports_collection, records_15m_collection, records_1h_collection, settings_collection,
+    client_rollups_collection, client_rollups_15m_collection, client_rollups_1h_collection,
+)
+
+logger = logging.getLogger("retention")
+
+# Tắt mặc định: khi bật, records thô cũ hơn RETENTION_RAW_DAYS sẽ bị xoá (chỉ còn bản rút gọn)
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "0").lower() in ("1", "true", "yes")
+RETENTION_RAW_DAYS = float(os.getenv("RETENTION_RAW_DAYS", 7))
+RETENTION_15M_DAYS = float(os.getenv("RETENTION_15M_DAYS", 90))
+# 0 = giữ bản theo giờ mãi mãi
+RETENTION_1H_DAYS = float(os.getenv("RETENTION_1H_DAYS", 0))
+# Chu kỳ chạy compaction (giây)
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 900))
+
+# Các tầng dữ liệu từ chi tiết nhất tới thô nhất. Tầng rút gọn có cùng các field với records
+# (dt_obj là đầu khoảng thời gian) nên filter_data / pipeline phân tích dùng chung được.
+# client_rollups của tầng rút gọn cũng vậy: bucket là đầu khoảng, devices.<device> là max clients trong khoảng.
+TIERS = [
+    {"name": "raw", "collection": reports_collection, "rollups": client_rollups_collection,
+     "minutes": None, "days": RETENTION_RAW_DAYS},
+    {"name": "15m", "collection": records_15m_collection, "rollups": client_rollups_15m_collection,
+     "minutes": 15, "days": RETENTION_15M_DAYS},
+    {"name": "1h", "collection": records_1h_collection, "rollups": client_rollups_1h_collection,
+     "minutes": 60, "days": RETENTION_1H_DAYS or None},
+]
+
+# Tính lại total = tổng clients của các device trong bucket
+ROLLUP_TOTAL = [{"$set": {"total": {"$sum": {"$map": {"input": {"$objectToArray": "$devices"}, "in": "$$this.v"}}}}}]
+ROLLUP_BATCH_SIZE = 1000
+
+
+def tier_for_window(hours=None):
+    """Tầng chi tiết nhất còn giữ đủ dữ liệu cho khoảng `hours` giờ gần nhất (None = toàn bộ lịch sử)."""
+    if not RETENTION_ENABLED:
+        return TIERS[0]
+    for tier in TIERS:
+        if tier["days"] is None or (hours and hours <= tier["days"] * 24):
+            return tier
+    return TIERS[-1]
+
+
+def collection_for_window(hours=None):
+    """Collection records của tier_for_window(hours)."""
+    return tier_for_window(hours)["collection"]
+
+
+def rollups_for_window(hours=None):
+    """Collection client_rollups của tier_for_window(hours)."""
+    return tier_for_window(hours)["rollups"]
+
+
+async def compacted_boundary():
+    """Mốc (đầu giờ) mà các tầng rút gọn đã có đủ dữ liệu; sau mốc này dữ liệu mới chỉ có ở tầng thô."""
+    state = await settings_collection.find_one({"type": "retention"}, {"compacted_until": 1}) or {}
+    until = state.get("compacted_until")
+    return until.replace(minute=0, second=0, microsecond=0) if until else datetime.min
+
+
+async def window_pipeline(hours, pipeline, rollups=False):
+    """(collection, pipeline) để chạy `pipeline` (bắt đầu bằng $match) trên khoảng `hours` giờ gần nhất.
+
+    Tầng rút gọn chỉ có dữ liệu tới lần compaction gần nhất: phần sau mốc đó được đọc từ tầng thô và rút gọn
+    ngay trong pipeline ($unionWith), nên biểu đồ / export khoảng dài vẫn có dữ liệu mới nhất.
+    rollups=True: pipeline chạy trên client_rollups thay vì records.
+    """
+    tier = tier_for_window(hours)
+    if tier["minutes"] is None:
+        return tier["rollups" if rollups else "collection"], pipeline
+    if rollups:
+        field, collection, source, stages = "bucket", tier["rollups"], client_rollups_collection, _rollup_tail_stages(tier)
+    else:
+        field, collection, source, stages = "dt_obj", tier["collection"], reports_collection, _downsample_stages(tier)
+    boundary = await compacted_boundary()
+    match = pipeline[0]["$match"]
+    return collection, [
+        {"$match": {"$and": [match, {field: {"$lt": boundary}}]}},
+        {"$unionWith": {"coll": source.name, "pipeline": [
+            {"$match": {"$and": [match, {field: {"$gte": boundary}}]}},
+            *stages,
+        ]}},
+        *pipeline[1:],
+    ]
+
+
+async def find_window(hours, query, projection, sort=None, batch_size=None):
+    """Như collection_for_window(hours).find(query, projection), kèm phần chưa compact của tầng rút gọn.
+
+    sort: tên field sắp xếp tăng dần.
+    """
+    if tier_for_window(hours)["minutes"] is None:
+        cursor = reports_collection.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort, 1)
+        return cursor.batch_size(batch_size) if batch_size else cursor
+    pipeline = [{"$match": query}, {"$project": projection}] + ([{"$sort": {sort: 1}}] if sort else [])
+    collection, pipeline = await window_pipeline(hours, pipeline)
+    options = {"batchSize": batch_size} if batch_size else {}
+    return collection.aggregate(pipeline, allowDiskUse=True, **options)
+
+
+async def mark_dirty(records):
+    """Ghi nhận có records mới (có thể là dữ liệu cũ được sync bù) để lần compaction sau tính lại từ mốc đó."""
+    if not RETENTION_ENABLED or not records:
+        return
+    oldest = min(r["dt_obj"] for r in records)
+    await settings_collection.update_one(
+        {"type": "retention"},
+        {"$min": {"dirty_from": oldest}, "$inc": {"dirty_version": 1}},
+        upsert=True,
+    )
+
+
+def _downsample_stages(tier):
+    """Gom records thô theo (site, device, khoảng thời gian của tầng): clients lấy MAX, health/state/model/ip lấy bản mới nhất."""
+    return [
+        {"$sort": {"dt_obj": 1}},
+        {"$group": {
+            "_id": {
+                "site": "$site",
+                "device": "$device",
+                "dt_obj": {"$dateTrunc": {"date": "$dt_obj", "unit": "minute", "binSize": tier["minutes"]}},
+            },
+            "clients": {"$max": "$clients"},
+            "health": {"$last": "$health"},
+            "state": {"$last": "$state"},
+            "model": {"$last": "$model"},
+            "ip": {"$last": "$ip"},
+            "last_dt": {"$last": "$dt_obj"},
+        }},
+        {"$project": {
+            "_id": 0, "site": "$_id.site", "device": "$_id.device", "dt_obj": "$_id.dt_obj",
+            "clients": 1, "health": 1, "state": 1, "model": 1, "ip": 1, "last_dt": 1,
+        }},
+    ]
+
+
+def _downsample_pipeline(match, tier):
+    """Rút gọn records thô (_downsample_stages) rồi $merge vào collection của tầng.
+
+    Khi merge với document đã có cũng theo quy tắc của _downsample_stages nên chạy lại trên cùng khoảng thời gian
+    (khoảng đang dở, dữ liệu sync bù) vẫn đúng.
+    """
+    def latest(field):
+        return {"$cond": [{"$gte": ["$$new.last_dt", "$last_dt"]}, f"$$new.{field}", f"${field}"]}
+
+    return [
+        {"$match": match},
+        *_downsample_stages(tier),
+        {"$merge": {
+            "into": tier["collection"].name,
+            "on": ["site", "device", "dt_obj"],
+            "whenMatched": [{"$set": {
+                "clients": {"$max": ["$clients", "$$new.clients"]},
+                "health": latest("health"),
+                "state": latest("state"),
+                "model": latest("model"),
+                "ip": latest("ip"),
+                "last_dt": {"$max": ["$last_dt", "$$new.last_dt"]},
+            }}],
+            "whenNotMatched": "insert",
+        }},
+    ]
+
+
+def _rollup_downsample_pipeline(match, tier):
+    """Gom client_rollups theo phút thành (site, khoảng thời gian của tầng): mỗi device lấy MAX clients trong khoảng."""
+    return [{"$match": match}, *_rollup_group_stages(tier)]
+
+
+def _rollup_group_stages(tier):
+    return [
+        {"$project": {
+            "site": 1,
+            "bucket": {"$dateTrunc": {"date": "$bucket", "unit": "minute", "binSize": tier["minutes"]}},
+            "devices": {"$objectToArray": "$devices"},
+        }},
+        {"$unwind": "$devices"},
+        {"$group": {
+            "_id": {"site": "$site", "bucket": "$bucket", "device": "$devices.k"},
+            "clients": {"$max": "$devices.v"},
+        }},
+        {"$group": {
+            "_id": {"site": "$_id.site", "bucket": "$_id.bucket"},
+            "devices": {"$push": {"k": "$_id.device", "v": "$clients"}},
+        }},
+    ]
+
+
+def _rollup_tail_stages(tier):
+    """_rollup_group_stages đưa về cùng dạng document của client_rollups ({site, bucket, devices, total})."""
+    return [
+        *_rollup_group_stages(tier),
+        {"$project": {"_id": 0, "site": "$_id.site", "bucket": "$_id.bucket", "devices": {"$arrayToObject": "$devices"}}},
+        *ROLLUP_TOTAL,
+    ]
+
+
+async def _compact_rollups(match, tier):
+    """Rút gọn client_rollups vào tầng. Ghi bằng $max như _update_client_rollups nên bucket đã có
+    (khoảng đang dở, dữ liệu sync bù sau khi các phút cũ đã bị xoá) không bị mất giá trị cũ."""
+    rollups = tier["rollups"]
+    ops = []
+    async for doc in client_rollups_collection.aggregate(_rollup_downsample_pipeline(match, tier), allowDiskUse=True):
+        ops.append(UpdateOne(
+            {"site": doc["_id"]["site"], "bucket": doc["_id"]["bucket"]},
+            {"$max": {f"devices.{d['k']}": d["v"] for d in doc["devices"]}},
+            upsert=True,
+        ))
+        if len(ops) >= ROLLUP_BATCH_SIZE:
+            await rollups.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await rollups.bulk_write(ops, ordered=False)
+    # Khoảng tính lại bắt đầu từ đầu giờ nên trùng ranh giới bucket của mọi tầng
+    await rollups.update_many(match, ROLLUP_TOTAL)
+
+
+async def compact_records(now=None):
+    """Một lượt compaction: rút gọn records thô và client_rollups mới vào các tầng 15m / 1h rồi xoá dữ liệu quá hạn của từng tầng.
+
+    Chỉ đọc records từ mốc đã compact lần trước (hoặc mốc dirty_from nếu vừa sync bù dữ liệu cũ hơn).
+    """
+    now = now or datetime.now()
+    state = await settings_collection.find_one({"type": "retention"}) or {}
+    starts = [d for d in (state.get("compacted_until"), state.get("dirty_from")) if d]
+
+    match = {"dt_obj": {"$lt": now}}
+    if starts:
+        # Lùi về đầu giờ để các khoảng 15m / 1h được tính lại từ đầu, không chỉ một phần
+        match["dt_obj"]["$gte"] = min(starts).replace(minute=0, second=0, microsecond=0)
+
+    rollup_match = {"bucket": match["dt_obj"]}
+    for tier in TIERS[1:]:
+        await reports_collection.aggregate(_downsample_pipeline(match, tier), allowDiskUse=True).to_list(length=None)
+        await _compact_rollups(rollup_match, tier)
+
+    await settings_collection.update_one({"type": "retention"}, {"$set": {"compacted_until": now}}, upsert=True)
+    # Có ingest mới trong lúc đang compact -> giữ dirty_from cho lần sau
+    await settings_collection.update_one(
+        {"type": "retention", "dirty_version": state.get("dirty_version")},
+        {"$unset": {"dirty_from": ""}},
+    )
+
+    # Records thô được sync bù trong lúc compact chưa được rút gọn -> chưa xoá
+    state = await settings_collection.find_one({"type": "retention"}) or {}
+    deleted = {}
+    for tier in TIERS:
+        if tier["days"] is None:
+            continue
+        cutoff = now - timedelta(days=tier["days"])
+        if tier["minutes"] is None and state.get("dirty_from"):
+            cutoff = min(cutoff, state["dirty_from"])
+        result = await tier["collection"].delete_many({"dt_obj": {"$lt": cutoff}})
+        deleted[tier["name"]] = result.deleted_count
+        result = await tier["rollups"].delete_many({"bucket": {"$lt": cutoff}})
+        deleted[f"{tier['name']} rollups"] = result.deleted_count
+    return deleted
+
+
+async def retention_loop(on_change=None):
+    """Chạy compact_records mỗi RETENTION_INTERVAL giây. on_change được gọi khi có dữ liệu bị xoá."""
+    logger.info("Retention loop started.")
+    while True:
+        try:
+            deleted = await compact_records()
+            if any(deleted.values()):
+                logger.info(f"Retention: deleted {deleted}")
+                if on_change:
+                    on_change()
+        except Exception as e:
+            logger.error(f"Retention Loop Error: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
@@ -0,0 +1,240 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database_mongo import sync_runs_collection, sync_tasks_collection
+
+logger = logging.getLogger("sync_coordinator")
+
+# Lease / task đã nhận hết hạn sau khoảng này (giây) nếu worker không gia hạn (worker chết, bị kill)
+SYNC_LEASE_SECONDS = float(os.getenv("SYNC_LEASE_SECONDS", 60))
+# Chu kỳ gia hạn lease / task và đẩy tiến độ của worker lên document chung
+SYNC_HEARTBEAT_SECONDS = float(os.getenv("SYNC_HEARTBEAT_SECONDS", 3))
+# File có snapshot trong số giờ gần nhất này được ingest xong trước khi bắt đầu nạp dữ liệu cũ (0 = không chia pha)
+SYNC_HOT_WINDOW_HOURS = float(os.getenv("SYNC_HOT_WINDOW_HOURS", 24))
+
+# Mỗi process uvicorn (mỗi worker, mỗi replica) là một worker
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+COUNTERS = ("files_done", "files_parsed", "records_written")
+ACTIVE_STATES = ("running", "finalizing")
+
+STEPS = {
+    "listing": "Scanning Cloudflare R2...",
+    "running": "Syncing {files_total} new files on {workers} worker(s)...",
+    "finalizing": "Saving sync state...",
+}
+
+
+def _priority_time(f):
+    """Thời điểm snapshot lấy từ tên file, không có thì LastModified của object (đổi về giờ local, không tz)."""
+    t = f.get("dt_obj") or f.get("last_modified")
+    if t is not None and t.tzinfo is not None:
+        t = t.astimezone().replace(tzinfo=None)
+    return t or datetime.min
+
+
+def schedule_files(files, hot_hours=SYNC_HOT_WINDOW_HOURS, now=None):
+    """Thứ tự xử lý các file của một lượt sync: mới nhất trước, để dashboard có dữ liệu gần đây ngay cả khi đang nạp lại lịch sử.
+
+    Đánh dấu "hot" các file trong hot_hours giờ gần nhất; worker ingest hết các file này rồi mới nhận file cũ hơn.
+    """
+    cutoff = (now or datetime.now()) - timedelta(hours=hot_hours) if hot_hours else None
+    ordered = sorted(files, key=_priority_time, reverse=True)
+    return [{**f, "hot": cutoff is not None and _priority_time(f) >= cutoff} for f in ordered]
+
+
+def _public_status(run, now=None):
+    """Document sync_runs -> các field của sync_status (tiến độ chung của mọi worker)."""
+    now = now or datetime.utcnow()
+    state = run.get("state")
+    syncing = state in ACTIVE_STATES or (state == "listing" and run.get("lease_until", now) > now)
+    status = {
+        "is_syncing": syncing,
+        "current_step": STEPS[state].format(files_total=run.get("files_total", 0), workers=len(run.get("workers", [])))
+                        if syncing else "Idle",
+        "files_total": run.get("files_total", 0),
+        "workers": run.get("workers", []),
+        **{c: run.get(c, 0) for c in COUNTERS},
+    }
+    if run.get("last_message"):
+        status["last_message"] = run["last_message"]
+    return status
+
+
+class SyncCoordinator:
+    """Điều phối sync R2 giữa nhiều worker uvicorn / nhiều replica qua MongoDB.
+
+    - Document sync_runs {_id: name} là lease: chỉ worker giữ lease mới được quét R2 và mở lượt sync mới,
+      đồng thời chứa tiến độ chung (files_done / files_parsed / records_written cộng dồn từ mọi worker).
+    - Mỗi file của lượt sync là một task trong sync_tasks. Mọi worker (kể cả worker mở lượt) nhận task
+      bằng find_one_and_update nên mỗi file chỉ được tải / parse bởi một worker.
+    - Lease và task đã nhận có hạn (lease_until) và được gia hạn bằng heartbeat; worker chết thì
+      task của nó hết hạn và được worker khác nhận lại.
+    - Worker thấy mọi task đã xong thì chốt lượt sync (lưu ETag / con trỏ R2).
+    """
+
+    def __init__(self, name="r2", worker_id=WORKER_ID):
+        self.name = name
+        self.worker_id = worker_id
+        self.progress = dict.fromkeys(COUNTERS, 0)
+        self._pushed = dict(self.progress)
+        # Gọi với tiến độ chung sau mỗi heartbeat (main.py đẩy ra SSE)
+        self.on_status = None
+
+    @staticmethod
+    def _until():
+        return datetime.utcnow() + timedelta(seconds=SYNC_LEASE_SECONDS)
+
+    async def status(self):
+        run = await sync_runs_collection.find_one({"_id": self.name})
+        return _public_status(run) if run else {}
+
+    async def active_run(self):
+        """run_id của lượt sync đang chạy (để tham gia), hoặc None."""
+        run = await sync_runs_collection.find_one({"_id": self.name, "state": {"$in": list(ACTIVE_STATES)}}, {"run_id": 1})
+        return run["run_id"] if run else None
+
+    async def due(self, interval):
+        """True nếu có lượt sync đang chạy để tham gia, hoặc lượt gần nhất bắt đầu cách đây quá interval giây."""
+        run = await sync_runs_collection.find_one({"_id": self.name}, {"state": 1, "started_at": 1})
+        if not run or run.get("state") in ACTIVE_STATES or not run.get("started_at"):
+            return True
+        return (datetime.utcnow() - run["started_at"]).total_seconds() >= interval
+
+    async def acquire_lease(self):
+        """Giữ lease để quét R2 và mở lượt sync mới. False nếu đang có lượt sync hoặc worker khác đang quét."""
+        now = datetime.utcnow()
+        try:
+            await sync_runs_collection.update_one(
+                {"_id": self.name, "state": {"$nin": list(ACTIVE_STATES)},
+                 "$or": [{"lease_until": {"$lt": now}}, {"owner": self.worker_id}]},
+                {"$set": {"owner": self.worker_id, "lease_until": self._until(), "state": "listing", "started_at": now}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Không khớp điều kiện -> upsert trùng _id: worker khác đang giữ lease
+            return False
+        return True
+
+    async def open_run(self, files, cursor_update):
+        """Tạo task cho từng file ({"key", "filename", "etag", "size"}, theo thứ tự xử lý) và mở lượt sync.
+
+        Trả về run_id, hoặc None nếu lease đã bị worker khác lấy (quét quá lâu, không kịp gia hạn).
+        """
+        run_id = uuid.uuid4().hex
+        await sync_tasks_collection.insert_many(
+            [{**f, "run_id": run_id, "order": i, "status": "pending"} for i, f in enumerate(files)]
+        )
+        result = await sync_runs_collection.update_one(
+            {"_id": self.name, "owner": self.worker_id, "state": "listing"},
+            {"$set": {"state": "running", "run_id": run_id, "cursor_update": cursor_update,
+                      "files_total": len(files), "workers": [], **dict.fromkeys(COUNTERS, 0)},
+             "$unset": {"last_message": ""}},
+        )
+        if not result.matched_count:
+            await sync_tasks_collection.delete_many({"run_id": run_id})
+            return None
+        return run_id
+
+    async def claim(self, run_id, hot=None):
+        """Nhận file tiếp theo của lượt sync (task chưa ai nhận hoặc đã hết hạn). None khi hết file.
+
+        hot=True / False: chỉ nhận file trong / ngoài hot window (xem schedule_files).
+        """
+        query = {"run_id": run_id, "$or": [{"status": "pending"}, {"status": "claimed", "lease_until": {"$lt": datetime.utcnow()}}]}
+        if hot is not None:
+            # Task không có field hot (lượt sync mở bởi phiên bản cũ) tính là file cũ
+            query["hot"] = True if hot else {"$ne": True}
+        task = await sync_tasks_collection.find_one_and_update(
+            query,
+            {"$set": {"status": "claimed", "worker": self.worker_id, "lease_until": self._until()}},
+            sort=[("order", 1)],
+            projection={"key": 1},
+        )
+        return task["key"] if task else None
+
+    async def heartbeat(self, run_id=None):
+        """Gia hạn lease (nếu đang giữ) và các task đang giữ, cộng phần tiến độ mới vào document chung."""
+        until = self._until()
+        await sync_runs_collection.update_one({"_id": self.name, "owner": self.worker_id}, {"$set": {"lease_until": until}})
+        if run_id is None:
+            return
+        await sync_tasks_collection.update_many(
+            {"run_id": run_id, "worker": self.worker_id, "status": "claimed"}, {"$set": {"lease_until": until}}
+        )
+        progress = dict(self.progress)
+        run = await sync_runs_collection.find_one_and_update(
+            {"_id": self.name, "run_id": run_id},
+            {"$inc": {c: progress[c] - self._pushed[c] for c in COUNTERS}, "$addToSet": {"workers": self.worker_id}},
+            return_document=ReturnDocument.AFTER,
+        )
+        self._pushed = progress
+        if run and self.on_status:
+            self.on_status(_public_status(run))
+
+    @contextlib.asynccontextmanager
+    async def working(self, run_id=None):
+        """Heartbeat mỗi SYNC_HEARTBEAT_SECONDS trong lúc worker đang quét R2 (run_id None) hoặc xử lý task."""
+        self.progress = dict.fromkeys(COUNTERS, 0)
+        self._pushed = dict(self.progress)
+
+        async def beat():
+            while True:
+                try:
+                    await self.heartbeat(run_id)
+                except Exception as e:
+                    logger.error(f"Sync heartbeat error: {e}")
+                await asyncio.sleep(SYNC_HEARTBEAT_SECONDS)
+
+        task = asyncio.create_task(beat())
+        try:
+            yield self
+        finally:
+            task.cancel()
+            try:
+                await self.heartbeat(run_id)
+            except Exception as e:
+                logger.error(f"Sync heartbeat error: {e}")
+
+    async def complete(self, run_id):
+        """Đánh dấu xong các task worker này đang giữ (gọi sau khi đã ghi xong vào MongoDB)."""
+        await sync_tasks_collection.update_many(
+            {"run_id": run_id, "worker": self.worker_id, "status": "claimed"}, {"$set": {"status": "done"}}
+        )
+
+    async def try_finish(self, run_id):
+        """Nhận việc chốt lượt sync nếu mọi task đã xong.
+
+        Trả về (cursor_update, files) cho đúng một worker; None nếu còn task hoặc worker khác đang chốt.
+        """
+        if await sync_tasks_collection.count_documents({"run_id": run_id, "status": {"$ne": "done"}}, limit=1):
+            return None
+        run = await sync_runs_collection.find_one_and_update(
+            {"_id": self.name, "run_id": run_id,
+             "$or": [{"state": "running"}, {"state": "finalizing", "lease_until": {"$lt": datetime.utcnow()}}]},
+            {"$set": {"state": "finalizing", "owner": self.worker_id, "lease_until": self._until()}},
+        )
+        if run is None:
+            return None
+        files = await sync_tasks_collection.find(
+            {"run_id": run_id}, {"_id": 0, "filename": 1, "key": 1, "etag": 1, "size": 1}
+        ).to_list(length=None)
+        return run.get("cursor_update", {}), files
+
+    async def close(self, message, run_id=None):
+        """Kết thúc lượt sync (hoặc lượt quét không có file mới) và trả lease."""
+        now = datetime.utcnow()
+        await sync_runs_collection.update_one(
+            {"_id": self.name, "owner": self.worker_id},
+            {"$set": {"state": "idle", "lease_until": now, "finished_at": now, "last_message": message}},
+        )
+        if run_id is not None:
+            await sync_tasks_collection.delete_many({"run_id": run_id})
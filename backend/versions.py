@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+
+from pymongo import ReturnDocument
+
+from database_mongo import sync_runs_collection
+
+logger = logging.getLogger("versions")
+
+# Chu kỳ (giây) mỗi worker đọc số phiên bản chung để biết process khác vừa ghi dữ liệu / sửa user / kết thúc sync
+VERSION_POLL_SECONDS = float(os.getenv("VERSION_POLL_SECONDS", 2))
+
+
+class SharedVersions:
+    """Số phiên bản dùng chung giữa các worker uvicorn / replica, lưu trong document sync_runs {_id: name}.
+
+    Cache (kết quả phân tích, hot window, token / user) và SSE nằm trong từng process. Process thay đổi dữ liệu
+    gọi bump(kind); các process khác thấy số đó đổi trong lần poll sau và chạy handler đăng ký bằng on(kind, ...)
+    (xoá cache của mình, gửi event tới client đang nghe).
+    """
+
+    def __init__(self, name="versions"):
+        self.name = name
+        self.seen = {}
+        self.handlers = {}
+        self._tasks = set()
+        self._pending = {}
+        self._last_bump = {}
+
+    def on(self, kind, handler):
+        """handler() (hàm thường hoặc coroutine) chạy khi process khác tăng phiên bản `kind`."""
+        self.handlers[kind] = handler
+
+    async def bump(self, kind):
+        doc = await sync_runs_collection.find_one_and_update(
+            {"_id": self.name}, {"$inc": {kind: 1}},
+            upsert=True, projection={kind: 1}, return_document=ReturnDocument.AFTER,
+        )
+        # Không có process khác tăng xen vào -> process này đã tự xử lý thay đổi của mình, poll không chạy lại handler
+        if self.seen.get(kind) == doc[kind] - 1:
+            self.seen[kind] = doc[kind]
+
+    def bump_soon(self, kind, min_interval=0):
+        """bump từ code đồng bộ (callback on_data_changed); bỏ qua nếu không chạy trong event loop.
+
+        Cách lần bump trước chưa tới `min_interval` giây thì chờ, các lần gọi trong lúc chờ gộp vào một lần bump.
+        """
+        pending = self._pending.get(kind)
+        if pending is not None and not pending.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        wait = 0
+        if kind in self._last_bump:
+            wait = max(0, self._last_bump[kind] + min_interval - loop.time())
+
+        async def bump_later():
+            await asyncio.sleep(wait)
+            self._last_bump[kind] = loop.time()
+            await self.bump(kind)
+
+        task = self._pending[kind] = loop.create_task(bump_later())
+        self._tasks.add(task)
+        task.add_done_callback(self._bumped)
+
+    def _bumped(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Version bump error: {task.exception()}")
+
+    async def poll(self):
+        """Đọc phiên bản hiện tại, chạy handler của các kind đã đổi. Lần đầu chỉ ghi nhận mốc."""
+        doc = await sync_runs_collection.find_one({"_id": self.name}) or {}
+        for kind, handler in self.handlers.items():
+            version = doc.get(kind, 0)
+            changed = kind in self.seen and self.seen[kind] != version
+            self.seen[kind] = version
+            if changed:
+                result = handler()
+                if asyncio.iscoroutine(result):
+                    await result
+
+    async def watch(self, interval=VERSION_POLL_SECONDS):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Version poll error: {e}")
+            await asyncio.sleep(interval)
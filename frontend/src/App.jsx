@@ -21,6 +21,10 @@ const API_BASE = (function () {
   }
   return `${protocol}//${hostname}:3001/api`;
 })();
+
+// Số điểm tối đa của biểu đồ clients, server tự rút gọn (LTTB) khi khoảng thời gian dài
+const MAX_CHART_POINTS = 600;
+
 const COLORS = ['#3b82f6', '#10b981', '#f59e0b', '#ef4444', '#8b5cf6', '#ec4899'];
 const METRICS_OPTIONS = [
   { value: 'clients', label: 'Total Clients' },
@@ -28,26 +32,8 @@ const METRICS_OPTIONS = [
   { value: 'state', label: 'Device State' }
 ];
 
-function SyncProgress({ API_BASE, getHeaders, triggerLoad, externalLoading }) {
-  const [status, setStatus] = useState({ is_syncing: false, current_step: "Idle", files_total: 0, files_done: 0, last_message: "" });
-
-  useEffect(() => {
-    let interval;
-    if (status.is_syncing || externalLoading) {
-      interval = setInterval(async () => {
-        try {
-          const res = await axios.get(`${API_BASE}/sync-status`, { headers: getHeaders() });
-          setStatus(res.data);
-          if (!res.data.is_syncing && !externalLoading) clearInterval(interval);
-        } catch (e) { clearInterval(interval); }
-      }, 1000);
-    } else {
-      // Poll một lần để lấy message cuối cùng
-      axios.get(`${API_BASE}/sync-status`, { headers: getHeaders() }).then(res => setStatus(res.data)).catch(() => { });
-    }
-    return () => clearInterval(interval);
-  }, [status.is_syncing, externalLoading]);
-
+// status được App cập nhật từ event "sync" của /api/events, không cần poll
+function SyncProgress({ status, triggerLoad, externalLoading }) {
   const progress = status.files_total > 0 ? Math.round((status.files_done / status.files_total) * 100) : 0;
 
   return (
@@ -58,7 +44,7 @@ function SyncProgress({ API_BASE, getHeaders, triggerLoad, externalLoading }) {
             {status.is_syncing ? status.current_step : "System Ready"}
           </span>
           {status.is_syncing && status.files_total > 0 && (
-            <span className="text-zinc-400">{status.files_done}/{status.files_total} files</span>
+            <span className="text-zinc-400">{status.files_done}/{status.files_total} files · {status.records_written} records</span>
           )}
         </div>
 
@@ -99,6 +85,9 @@ function App() {
   const [loading, setLoading] = useState(false);
   const [status, setStatus] = useState("");
   const [refreshTrigger, setRefreshTrigger] = useState(0);
+  const [syncStatus, setSyncStatus] = useState({ is_syncing: false, current_step: "Idle", files_total: 0, files_done: 0, files_parsed: 0, records_written: 0, last_message: "" });
+  const [widgetResults, setWidgetResults] = useState({});
+  const [widgetsLoading, setWidgetsLoading] = useState(false);
   const [isExporting, setIsExporting] = useState(false);
   const [enabledMetrics, setEnabledMetrics] = useState(['clients', 'health', 'state']);
   const [summaryData, setSummaryData] = useState({ connectivity: "0%", alerts: 0, total_clients: 0 });
@@ -187,6 +176,55 @@ function App() {
 
   useEffect(() => { if (user) handleLoad(); }, [user]);
 
+  // Tính tất cả widget trong một request /analyze/batch thay vì mỗi widget một request
+  const fetchWidgets = async (list) => {
+    if (!list.length) { setWidgetResults({}); return; }
+    setWidgetsLoading(true);
+    try {
+      const res = await axios.post(`${API_BASE}/analyze/batch`, {
+        widgets: list.map(w => {
+          const timeRange = w.timeRange || "24";
+          return {
+            id: w.id,
+            site: w.site,
+            device: w.device,
+            metric: w.metric,
+            hours: timeRange === "0" ? null : parseInt(timeRange),
+            max_points: MAX_CHART_POINTS
+          };
+        })
+      }, { headers: getHeaders() });
+      const results = {};
+      let lastSummary = null;
+      res.data.results.forEach((r, i) => {
+        results[r.id] = r.data || [];
+        if (r.summary) lastSummary = { site: list[i].site, data: r.summary };
+      });
+      setWidgetResults(results);
+      if (lastSummary) {
+        setSummaryData(lastSummary.data);
+        setCurrentSummarySite(lastSummary.site === "All Sites" ? "Global Overview" : lastSummary.site);
+      }
+    } catch (err) {
+      if (err.response?.status === 401) handleLogout();
+    }
+    setWidgetsLoading(false);
+  };
+
+  useEffect(() => {
+    if (!user) return;
+    fetchWidgets(widgets);
+  }, [widgets, refreshTrigger]);
+
+  // Server đẩy tiến độ sync và báo có dữ liệu mới qua SSE thay cho việc poll
+  useEffect(() => {
+    if (!user) return;
+    const source = new EventSource(`${API_BASE}/events?token=${encodeURIComponent(localStorage.getItem("token"))}`);
+    source.addEventListener("sync", (e) => setSyncStatus(JSON.parse(e.data)));
+    source.addEventListener("data_changed", () => setRefreshTrigger(t => t + 1));
+    return () => source.close();
+  }, [user]);
+
   const generateReport = async () => {
     const element = document.getElementById('dashboard-content');
     if (!element) {
@@ -450,7 +488,7 @@ function App() {
                     </CardTitle>
                   </CardHeader>
                   <CardContent className="pt-5 space-y-4">
-                    <SyncProgress API_BASE={API_BASE} getHeaders={getHeaders} triggerLoad={handleLoad} externalLoading={loading} />
+                    <SyncProgress status={syncStatus} triggerLoad={handleLoad} externalLoading={loading} />
                   </CardContent>
                 </Card>
               )}
@@ -509,15 +547,10 @@ function App() {
                   <div key={w.id} className="lg:col-span-1">
                     <WidgetCard
                       widget={w}
-                      refreshTrigger={refreshTrigger}
+                      data={widgetResults[w.id] || []}
+                      loading={widgetsLoading && !(w.id in widgetResults)}
                       onRemove={() => removeWidget(w.id)}
                       onUpdateTime={(time) => updateWidgetTime(w.id, time)}
-                      onSummaryUpdate={(site, data) => {
-                        if (data) {
-                          setSummaryData(data);
-                          setCurrentSummarySite(site === "All Sites" ? "Global Overview" : site);
-                        }
-                      }}
                     />
                   </div>
                 ))}
@@ -540,29 +573,10 @@ const TIME_OPTIONS = [
   { label: "7 ngày", value: "168" },
 ];
 
-function WidgetCard({ widget, onRemove, onUpdateTime, refreshTrigger, onSummaryUpdate }) {
-  const [data, setData] = useState([]);
-  const [loading, setLoading] = useState(true);
+function WidgetCard({ widget, data, loading, onRemove, onUpdateTime }) {
   const [isExporting, setIsExporting] = useState(false);
   const timeRange = widget.timeRange || "24";
 
-  const fetchData = async () => {
-    setLoading(true);
-    try {
-      const res = await axios.post(`${API_BASE}/analyze`, {
-        site: widget.site,
-        device: widget.device,
-        metric: widget.metric,
-        hours: timeRange === "0" ? null : parseInt(timeRange)
-      }, { headers: { Authorization: `Bearer ${localStorage.getItem("token")}` } });
-      setData(res.data.data || []);
-      if (res.data.summary && onSummaryUpdate) {
-        onSummaryUpdate(widget.site, res.data.summary);
-      }
-    } catch (err) { }
-    setLoading(false);
-  };
-
   const exportCSV = () => {
     if (!data || data.length === 0) return;
 
@@ -585,12 +599,6 @@ function WidgetCard({ widget, onRemove, onUpdateTime, refreshTrigger, onSummaryU
     document.body.removeChild(link);
   };
 
-  useEffect(() => {
-    fetchData();
-    const interval = setInterval(fetchData, 60000);
-    return () => clearInterval(interval);
-  }, [widget, timeRange, refreshTrigger]);
-
   const exportWidgetAsImage = async () => {
     const element = document.getElementById(`widget-${widget.id}`);
     if (!element) {